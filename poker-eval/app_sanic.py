@@ -1,26 +1,62 @@
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import os
+
 from sanic import Sanic
 from sanic import response
 from pokereval import PokerEval
 
+# term/pe/sampling.py, mounted by start_container.sh
+from sampling import sample_adaptively
+
 
 GAME = 'holdem'
 ITERATIONS = 20000
+# iterations between standard error checks when sampling adaptively
+CHUNK = 500
+# poker_eval blocks, so evaluations run in a pool of processes (each with its own PokerEval)
+WORKERS = os.cpu_count() or 1
 
 app = Sanic()
 pe = PokerEval()
+executor = ProcessPoolExecutor(WORKERS)
+
+
+def evaluate(board, pockets, iterations=ITERATIONS, stderr=None, budget=None, exact=False):
+    """Equities for the pockets on the board. With a target standard error and/or a time budget
+    (seconds) the iterations are sampled in chunks and stop as soon as every pocket's equity is
+    within the stderr, or the budget is spent. The iterations used are returned in info[0].
+    With exact every deal of the unknown cards is enumerated."""
+    if exact:
+        return pe.poker_eval(game=GAME, board=board, pockets=pockets)
+    if not stderr and not budget:
+        return pe.poker_eval(iterations=iterations, game=GAME, board=board, pockets=pockets)
+    return sample_adaptively(
+        lambda chunk: pe.poker_eval(iterations=chunk, game=GAME, board=board, pockets=pockets),
+        iterations, CHUNK, stderr, budget)
+
+
+async def run(job):
+    """Evaluates the job in the process pool without blocking the event loop"""
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(executor, partial(evaluate, **job))
 
 
 @app.post('/')
 async def post_handler(request):
-    data = request.json
-    equities = pe.poker_eval(
-        iterations=ITERATIONS,
-        game=GAME,
-        **data
-    )
+    equities = await run(request.json)
     return response.json(equities)
 
 
+@app.post('/batch')
+async def batch_handler(request):
+    """Evaluates a list of {board, pockets} jobs in one request, spread over the pool"""
+    jobs = request.json['jobs']
+    results = await asyncio.gather(*[run(job) for job in jobs])
+    return response.json({'results': results})
+
+
 @app.get('/')
 async def get_handler(request):
     return response.text('https://github.com/minmax/pypoker-eval')
@@ -1,3 +1,3 @@
 #!/bin/sh
 docker build -t spokereval .
-docker run --name spokereval -it -p 5657:5657 -v $PWD:/opt/pe spokereval python /opt/pe/app_sanic.py
+docker run --name spokereval -it -p 5657:5657 -v $PWD:/opt/pe -v $PWD/../term/pe/sampling.py:/opt/shared/sampling.py -e PYTHONPATH=/opt/shared spokereval python /opt/pe/app_sanic.py
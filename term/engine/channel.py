@@ -0,0 +1,154 @@
+import logging
+import mmap
+import os
+from os.path import dirname, realpath, join
+import pickle
+import struct
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class EngineChannelError(Exception):
+    """Engine state does not fit in the channel"""
+
+
+class EngineChannel:
+    """Latest engine state handed from the game to the MC watcher through a memory mapped file.
+
+    The header is a seqlock: the writer makes the sequence odd, writes, and makes it even again.
+    A reader copies the state and keeps it only if the sequence was even and did not change
+    meanwhile, so nobody waits on a lock and an unchanged sequence costs a single unpack.
+
+    The whole engine is only pickled when a new one is published (new hand, undo); after its
+    actions only its snapshot is written, which the reader restores onto its copy.
+    """
+
+    FILE = join(dirname(realpath(__file__)), 'engine.mmap')
+    ENGINE_SIZE = 1 << 22
+    SNAPSHOT_SIZE = 1 << 20
+    # sequence, generation (one per published engine), engine length, snapshot length
+    HEADER = struct.Struct('<QQQQ')
+    # seconds between polls while waiting for an engine, doubling up to MAX_POLL
+    POLL = 0.001
+    MAX_POLL = 0.05
+    # tries to read a state that is being written: the first spin, the rest sleep POLL. Then the
+    # read gives up till the next poll, so a writer that died mid-publish does not hang the reader
+    READ_SPINS = 100
+    READ_TRIES = 200
+
+    def __init__(self, path=FILE):
+        self.path = path
+        self.mm = None
+        # writer
+        self.sequence = 0
+        self.generation = 0
+        self.published = None
+        # reader
+        self.read_sequence = None
+        self.read_generation = None
+        self.engine = None
+        self.torn_sequence = None
+
+    @property
+    def size(self):
+        return self.HEADER.size + self.ENGINE_SIZE + self.SNAPSHOT_SIZE
+
+    def open(self, create=False):
+        if self.mm is not None:
+            return self.mm
+        if not create and (not os.path.exists(self.path) or os.path.getsize(self.path) < self.size):
+            return None
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT)
+        try:
+            if create:
+                os.ftruncate(fd, self.size)
+            self.mm = mmap.mmap(fd, self.size)
+        finally:
+            os.close(fd)
+        if create:
+            # carry on from an earlier writer so readers do not mistake new states for old ones
+            sequence, self.generation, _, _ = self.HEADER.unpack_from(self.mm, 0)
+            self.sequence = sequence + sequence % 2
+        return self.mm
+
+    def publish(self, engine):
+        """Writes the state of the engine, all of it if it was not published before"""
+        mm = self.open(create=True)
+        snapshot = pickle.dumps(engine.snapshot(), pickle.HIGHEST_PROTOCOL)
+        if len(snapshot) > self.SNAPSHOT_SIZE:
+            raise EngineChannelError(f'engine snapshot of {len(snapshot)} bytes is too large')
+        if engine is not self.published:
+            data = pickle.dumps(engine, pickle.HIGHEST_PROTOCOL)
+            if len(data) > self.ENGINE_SIZE:
+                raise EngineChannelError(f'engine of {len(data)} bytes is too large')
+            self.generation += 1
+            self.published = engine
+        else:
+            data = None
+        _, _, engine_len, _ = self.HEADER.unpack_from(mm, 0)
+        self.sequence += 1
+        self.HEADER.pack_into(mm, 0, self.sequence, self.generation, engine_len, 0)
+        if data is not None:
+            mm[self.HEADER.size:self.HEADER.size + len(data)] = data
+            engine_len = len(data)
+        offset = self.HEADER.size + self.ENGINE_SIZE
+        mm[offset:offset + len(snapshot)] = snapshot
+        self.sequence += 1
+        self.HEADER.pack_into(mm, 0, self.sequence, self.generation, engine_len, len(snapshot))
+        logger.debug(f'engine published as {self.generation}.{self.sequence}')
+
+    def read(self):
+        """Consistent copy of (sequence, generation, engine bytes or None if known, snapshot bytes),
+        None when nothing changed"""
+        mm = self.open()
+        if mm is None:
+            return None
+        for attempt in range(self.READ_TRIES):
+            if attempt >= self.READ_SPINS:
+                time.sleep(self.POLL)
+            sequence, generation, engine_len, snapshot_len = self.HEADER.unpack_from(mm, 0)
+            if sequence == self.read_sequence:
+                return None
+            if sequence % 2:
+                continue
+            data = None
+            if generation != self.read_generation:
+                data = mm[self.HEADER.size:self.HEADER.size + engine_len]
+            offset = self.HEADER.size + self.ENGINE_SIZE
+            snapshot = mm[offset:offset + snapshot_len]
+            if self.HEADER.unpack_from(mm, 0)[0] == sequence:
+                return sequence, generation, data, snapshot
+        if sequence != self.torn_sequence:
+            logger.warning(f'engine {sequence} is still being written after {self.READ_TRIES} reads')
+            self.torn_sequence = sequence
+        return None
+
+    def receive(self):
+        """The latest engine if its state changed since last received, else None. An engine
+        that only acted is restored in place, so the same object is returned."""
+        state = self.read()
+        if state is None:
+            return None
+        sequence, generation, data, snapshot = state
+        if data is not None:
+            self.engine = pickle.loads(data)
+            self.read_generation = generation
+        self.engine.restore(pickle.loads(snapshot))
+        self.read_sequence = sequence
+        return self.engine
+
+    def wait(self):
+        """Blocks till an engine state is received. Polls back off, so a state that follows
+        quickly is picked up at once and a long wait costs little"""
+        poll = self.POLL
+        while True:
+            engine = self.receive()
+            if engine is not None:
+                return engine
+            time.sleep(poll)
+            poll = min(poll * 2, self.MAX_POLL)
+
+
+engine_channel = EngineChannel()
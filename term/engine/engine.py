@@ -3,9 +3,8 @@ from copy import deepcopy
 from hashlib import md5
 import json
 import logging
-from os.path import dirname, realpath, join
-import shelve
 
+from engine.channel import engine_channel
 from es.es import ES
 from pe.pe import PE
 
@@ -61,8 +60,6 @@ class Engine:
         5: PHASE_RIVER,
     }
 
-    FILE = join(dirname(realpath(__file__)), 'engine')
-
     def __init__(self, site_name, button, players, sb, bb, ante=0, *args, **kwargs):
         logger.info(f'Engine site_name: {site_name}')
         logger.info(f'Engine button: {button}')
@@ -114,20 +111,16 @@ class Engine:
         self.pe_equities = {}
 
         # hand_strength = PE.hand_strength(['__', '__'], self.board, self.rivals)
-        for s, d in self.data.items():
-            if 'in' not in d['status']:
-                continue
-            self.data[s]['stats'] = ES.player_stats(self, s)
-            self.players[s]['hand_range'] = ES.cut_hand_range(self.data[s]['stats'])
+        seats = [s for s, d in self.data.items() if 'in' in d['status']]
+        for s, stats in ES.players_stats(self, seats).items():
+            self.data[s]['stats'] = stats
+            self.players[s]['hand_range'] = ES.cut_hand_range(stats)
             self.data[s]['strength'] = 0.20
 
     def save(self):
-        """saves game. this state should be threadsafe"""
-        logger.info('saving engine state...')
-        with shelve.open(self.FILE) as shlv:
-            shlv['hash'] = json.dumps(self.data, sort_keys=True)
-            shlv['engine'] = self
-        logger.info('engine state saved to {}'.format(self.FILE))
+        """Publishes the state for the MC watcher"""
+        engine_channel.publish(self)
+        logger.info('engine state published')
 
     def __copy__(self):
         cls = self.__class__
@@ -143,6 +136,51 @@ class Engine:
             setattr(result, k, deepcopy(v, memo))
         return result
 
+    # state changed by playing actions, see snapshot
+    STATE_ATTRS = ['pot', 'phase', 'rivals', 'winner', 'go_to_showdown', 'board']
+    PHASES = [PHASE_PREFLOP, PHASE_FLOP, PHASE_TURN, PHASE_RIVER, PHASE_SHOWDOWN]
+
+    def snapshot(self):
+        """Compact copy of everything actions change, for restore to rewind the engine in place.
+
+        Player data is copied one level deep: action lists only get appended to, and their
+        entries, the stats and the hand ranges are never changed, so they are shared.
+        The queue is kept as seats."""
+        return {
+            'data': {s: copy_values(d) for s, d in self.data.items()},
+            'balances': {s: p['balance'] for s, p in self.players.items()},
+            'phases': {ph: dict(getattr(self, ph)) for ph in self.PHASES},
+            'q': [s for s, _ in self.q] if self.q is not None else None,
+            'attrs': {k: getattr(self, k) for k in self.STATE_ATTRS},
+        }
+
+    def restore(self, snapshot):
+        """Rewinds to the snapshot without replacing the dicts other objects refer to"""
+        for s, d in snapshot['data'].items():
+            self.data[s].clear()
+            self.data[s].update(copy_values(d))
+        for s, balance in snapshot['balances'].items():
+            self.players[s]['balance'] = balance
+        for ph, phase_data in snapshot['phases'].items():
+            getattr(self, ph).clear()
+            getattr(self, ph).update(phase_data)
+        if snapshot['q'] is None:
+            self.q = None
+        else:
+            self.q = deque((s, self.players[s]) for s in snapshot['q'])
+        for k, v in snapshot['attrs'].items():
+            setattr(self, k, v)
+
+    def state_key(self):
+        """Hashable betting state, the same for action orders that end up in the same spot"""
+        return (
+            self.phase,
+            tuple(self.board),
+            tuple((s, d['status'], d['contrib'], d['matched']) for s, d in sorted(self.data.items())),
+            self.pot,
+            self.q[0][0] if self.q else None,
+        )
+
     def player_queue(self):
         """
         Returns deque of players starting with player after button/dealer
@@ -801,6 +839,11 @@ class Engine:
             return 0
 
 
+def copy_values(d):
+    """Copy of the dict with its lists copied too"""
+    return {k: list(v) if isinstance(v, list) else v for k, v in d.items()}
+
+
 class EngineError(ValueError):
     """Error during engine DO method."""
 
@@ -0,0 +1,102 @@
+import hashlib
+import json
+import logging
+from threading import Lock
+import time
+
+from lru import LRUCache
+
+
+logger = logging.getLogger(__name__)
+
+
+class QueryCache:
+    """Query results by a hash of the normalised query, with a TTL and LRU eviction.
+
+    Entries are filed under the player the query favours, so saving new docs of a player drops
+    just that player's results. Other players' docs also score (lower) in a query, the TTL
+    bounds how stale that makes a result.
+    """
+
+    def __init__(self, maxsize, ttl):
+        # (player, result) by query key
+        self.results = LRUCache(maxsize, ttl)
+        self.lock = Lock()
+        # invalidations per player, results computed across one are not kept
+        self.generations = {}
+        self.stats = {
+            'invalidated': 0,
+            'hit_time': 0.,
+            'miss_time': 0.,
+        }
+
+    @staticmethod
+    def key(query):
+        """md5 of the query as json with sorted keys"""
+        body = json.dumps(query, sort_keys=True, separators=(',', ':'), default=str)
+        return hashlib.md5(body.encode()).hexdigest()
+
+    def get(self, key):
+        """The cached value, None if missing or expired"""
+        entry = self.results.get(key)
+        return None if entry is None else entry[1]
+
+    def put(self, key, player, value, generation=None):
+        with self.lock:
+            if generation is not None and generation != self.generations.get(player, 0):
+                return
+            self.results.put(key, (player, value))
+
+    def fetch(self, query, player, compute):
+        """Cached result of the query, else computed and cached"""
+        start = time.time()
+        key = self.key(query)
+        value = self.get(key)
+        if value is not None:
+            self.count('hit_time', start)
+            return value
+        generation = self.generations.get(player, 0)
+        value = compute()
+        self.put(key, player, value, generation)
+        self.count('miss_time', start)
+        return value
+
+    def fetch_many(self, queries, players, compute_many):
+        """Cached results of the queries, the missing ones computed together by compute_many"""
+        start = time.time()
+        keys = [self.key(q) for q in queries]
+        values = [self.get(k) for k in keys]
+        missing = [i for i, v in enumerate(values) if v is None]
+        for _ in range(len(values) - len(missing)):
+            self.count('hit_time', start)
+        if missing:
+            start = time.time()
+            generations = [self.generations.get(p, 0) for p in players]
+            for i, value in zip(missing, compute_many([queries[i] for i in missing])):
+                self.put(keys[i], players[i], value, generations[i])
+                values[i] = value
+            for _ in missing:
+                self.count('miss_time', start)
+        return values
+
+    def count(self, timer, start):
+        with self.lock:
+            self.stats[timer] += time.time() - start
+
+    def invalidate(self, player):
+        """Drops the results of the player"""
+        with self.lock:
+            self.generations[player] = self.generations.get(player, 0) + 1
+            self.stats['invalidated'] += self.results.remove_if(lambda key, entry: entry[0] == player)
+
+    def clear(self):
+        self.results.clear()
+
+    def info(self):
+        """LRU counters and size, invalidations, mean hit and miss latencies in ms"""
+        info = self.results.info()
+        with self.lock:
+            info['invalidated'] = self.stats['invalidated']
+            info['hit_time'] = self.stats['hit_time'] / info['hits'] * 1000 if info['hits'] else 0
+            info['miss_time'] = self.stats['miss_time'] / info['misses'] * 1000 if info['misses'] else 0
+        return info
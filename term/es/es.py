@@ -1,13 +1,22 @@
 from collections import Counter
 import datetime
+from functools import lru_cache, partial
+import atexit
+from copy import deepcopy
 import json
 import time
 import logging
+import os
+from elasticsearch import helpers
 from elasticsearch_dsl.connections import connections
-from elasticsearch_dsl import Index, DocType, String, Date, Integer, Float, Boolean, Q, A, TermsFacet
+from elasticsearch_dsl import Index, DocType, MultiSearch, String, Date, Integer, Float, Boolean, Q, A, \
+    TermsFacet
 from operator import pos
 from sortedcontainers import SortedDict
 
+from es.cache import QueryCache
+from es.profiles import PlayerProfiles, player_profiles, history_prefix, PHASES
+from es.writer import GameWriter
 from pe.pe import PE
 from pocket_rankings.pocket_rankings import PocketRankings
 
@@ -15,16 +24,9 @@ from pocket_rankings.pocket_rankings import PocketRankings
 logger = logging.getLogger(__name__)
 
 
-connections.create_connection(hosts=['localhost'])
-
 INDEX_NAME = 'poker'
 
 es_index = Index(INDEX_NAME)
-# for index in connections.get_connection().indices.get('*'):
-#   print(index)
-# es_index.delete(ignore=404)
-es_index.create(ignore=400)
-# logger.info('index truncated')
 
 
 @es_index.doc_type
@@ -89,13 +91,144 @@ class GameAction(DocType):
     created_at = Date()
 
 
-GameAction.init()
+@lru_cache(maxsize=None)
+def connect():
+    """Connects to Elasticsearch and creates the index on first use. Returns the number of
+    active primary shards"""
+    connections.create_connection(hosts=['localhost'])
+    # for index in connections.get_connection().indices.get('*'):
+    #   print(index)
+    # es_index.delete(ignore=404)
+    es_index.create(ignore=400)
+    # logger.info('index truncated')
+    GameAction.init()
+
+    cluster_health = connections.get_connection().cluster.health()
+    for k, v in cluster_health.items():
+        logger.info('Cluster health: {}: {}'.format(k, v))
+    return cluster_health['active_primary_shards']
+
+
+class ElasticBackend:
+    """Game actions in Elasticsearch"""
+
+    def search(self, function_score, sample_size, terms_field=None, percentiles_field=None, percents=(),
+               docs_size=0):
+        active_primary_shards = connect()
+        sea = GameAction.search()
+        sea = sea.query(function_score)
+        sea = sea.sort('_score', {'created_at': 'desc'})
+
+        # establish which doc field is to be aggregated on for this player
+        docs_per_shard = sample_size / active_primary_shards
+        # # logger.info('docs per shard = {}'.format(docs_per_shard))
+
+        sample = A('sampler', shard_size=docs_per_shard)
+        mesam = sea.aggs.bucket('mesam', sample)
+        if percentiles_field:
+            mesam.metric('pottie', A('percentiles', field=percentiles_field, percents=percents))
+        if terms_field:
+            mesam.bucket('aksies', A('terms', field=terms_field))
+        return sea[:docs_size]
+
+    @staticmethod
+    def aggs(res, terms_field=None, percentiles_field=None, percents=()):
+        """(terms counts, percentiles) of a sampled response"""
+        assert res._shards['failed'] == 0
+        terms = {}
+        if terms_field:
+            terms = {b['key']: b['doc_count'] for b in res.aggregations.mesam.aksies.buckets}
+        percentiles = {}
+        if percentiles_field:
+            values = res.aggregations.mesam.pottie['values'].to_dict()
+            for p in percents:
+                value = values.get(f'{float(p)}')
+                percentiles[p] = float(value) if isinstance(value, (int, float)) and value == value else None
+        return terms, percentiles
+
+    def sample_aggs(self, function_score, sample_size, terms_field=None, percentiles_field=None, percents=(),
+                    docs_size=0):
+        """Terms counts and percentiles over the sample_size best scoring docs (sampler agg).
+        With docs_size the response with the best docs is returned instead."""
+        res = self.search(function_score, sample_size, terms_field, percentiles_field, percents, docs_size).execute()
+        if docs_size:
+            assert res._shards['failed'] == 0
+            return res
+        return self.aggs(res, terms_field, percentiles_field, percents)
+
+    def sample_aggs_many(self, requests):
+        """sample_aggs of every request (a dict of its arguments) with one multi search"""
+        if not requests:
+            return []
+        ms = MultiSearch(index=INDEX_NAME)
+        for request in requests:
+            ms = ms.add(self.search(**request))
+        return [self.aggs(res, request.get('terms_field'), request.get('percentiles_field'),
+                          request.get('percents', ()))
+                for request, res in zip(requests, ms.execute())]
+
+    def save(self, doc):
+        connect()
+        GameAction(**doc).save()
+
+    def save_many(self, docs):
+        """Indexes the docs with one bulk request, returns the docs that were indexed"""
+        connect()
+        actions = []
+        for doc in docs:
+            doc = dict(doc)
+            action = {'_index': INDEX_NAME, '_type': GameAction._doc_type.name}
+            if '_id' in doc:
+                action['_id'] = doc.pop('_id')
+            action['_source'] = GameAction(**doc).to_dict()
+            actions.append(action)
+        # results come in the order of the actions
+        results = helpers.streaming_bulk(connections.get_connection(), actions, raise_on_error=False)
+        saved = []
+        for doc, (ok, result) in zip(docs, results):
+            if ok:
+                saved.append(doc)
+            else:
+                logger.error(f'could not index doc {doc.get("_id")}: {result}')
+        return saved
+
+    def player_counts(self):
+        """(player, docs) most docs first"""
+        connect()
+        sea = GameAction.search()
+        players_terms = A('terms', field='player')
+        sea.aggs.bucket('players', players_terms)
+        sea = sea[:0]
+        res = sea.execute()
+        # print(repr(res.aggregations['players']['buckets']))
+        return [(item['key'], item['doc_count']) for item in res.aggregations['players']['buckets']]
+
+    def delete_player(self, player_name):
+        connect()
+        q = Q('bool', must=Q('match', player=player_name))
+        sea = GameAction.search()
+        sea = sea.query(q)
 
+        res = sea.execute()
+        print(res.hits.total)
+        time.sleep(3)
 
-cluster_health = connections.get_connection().cluster.health()
-for k, v in cluster_health.items():
-    logger.info('Cluster health: {}: {}'.format(k, v))
-active_primary_shards = cluster_health['active_primary_shards']
+        deleted = 0
+        for hit in sea.scan():
+            print(hit['player'], hit._id)
+            hit.delete()
+            deleted += 1
+        return deleted
+
+
+@lru_cache(maxsize=None)
+def backend(name):
+    if name == 'local':
+        from es.local import LocalStore
+        return LocalStore()
+    if name == 'es':
+        return ElasticBackend()
+    raise ValueError(f'unknown stats backend {name}')
 
 
 pocket_rankings = PocketRankings.load()
@@ -103,7 +236,36 @@ pocket_rankings = PocketRankings.load()
 
 class ES:
 
+    # where game actions are kept: 'es' for Elasticsearch, 'local' for an SQLite file (es/local.py)
+    BACKEND = os.environ.get('STATS_BACKEND', 'es')
     SAMPLE_SIZE = 1 << 8
+    # pot odds within a bucket share stats in the MC
+    PO_BUCKET = 0.01
+    # percentiles of the bet to pot ratios of bets and raises
+    BTP_PERCENTS = [10, 30, 50, 70, 90]
+    # player profiles with at least this many docs answer without a query
+    PROFILE_DOCS = 30
+    # query results kept (dropped when the player's docs are saved)
+    QUERY_CACHE_SIZE = 1 << 12
+    QUERY_CACHE_TTL = 10 * 60
+
+    @classmethod
+    def backend(cls):
+        return backend(cls.BACKEND)
+
+    @classmethod
+    def sample_aggs(cls, player, request):
+        """Backend sample_aggs of the request through the query cache"""
+        return query_cache.fetch(request, player, lambda: cls.backend().sample_aggs(**request))
+
+    @classmethod
+    def sample_aggs_many(cls, players, requests):
+        """Backend sample_aggs_many of the requests that are not cached"""
+        return query_cache.fetch_many(requests, players, cls.backend().sample_aggs_many)
+
+    @classmethod
+    def cache_info(cls):
+        return query_cache.info()
 
     @classmethod
     def cut_hand_range(cls, stats):
@@ -118,8 +280,9 @@ class ES:
         return hand_range
 
     @classmethod
-    def player_stats(cls, engine, seat, docs_size=0):
-        """Get the stats for this history of actions, favouring the current player.
+    def stats_request(cls, engine, seat):
+        """The player's street and the sample_aggs request for the stats of this history of
+        actions, favouring the current player.
 
         Given number of players
         For every player,
@@ -172,19 +335,7 @@ class ES:
 
         # CURRENT
         # agg field
-        agg_phase = engine.phase
-        if not d[agg_phase]:
-            agg_turn = 1
-        elif len(d[agg_phase]) < 2:
-            agg_turn = 2
-        else:
-            agg_turn = 1
-            if agg_phase == engine.PHASE_PREFLOP:
-                agg_phase = engine.PHASE_FLOP
-            elif agg_phase == engine.PHASE_FLOP:
-                agg_phase = engine.PHASE_TURN
-            else:
-                agg_phase = engine.PHASE_RIVER
+        agg_phase, agg_turn = cls.agg_street(engine, d)
         agg_field = f'{agg_phase}_{agg_turn}'
 
         # exclude blinds and
@@ -194,31 +345,15 @@ class ES:
                 {'term': {agg_field: 'l'}}
             ]
 
-        # get current sitwrap
-        contribs_all = [pd['contrib'] for pd in engine.data.values()]
-        total_contribs = sum(contribs_all)
-        max_contrib = max(contribs_all)
-        contrib_short = max_contrib - d['contrib']
-
         # facing aggression? (currently, not historically like in engine.do)
-        pot_odds = None
-        if contrib_short:
-            could_limp = True if engine.phase == engine.PHASE_PREFLOP and max_contrib == engine.bb_amt else False
-            if not could_limp:
-                # facing aggro now?
-                query['bool']['should'].append({'match': {f'{agg_phase}_aggro': {'query': True, 'boost': 4, '_name': f'{agg_phase}_aggro'}}})
-                # what is po now?
-                balance_left = p['balance'] - d['contrib']
-                pot_odds = min(balance_left, contrib_short) / max(1, (engine.pot + total_contribs))
-                scoring_functions.append(
-                    {'gauss': {f'{agg_field}_po': {'origin': pot_odds, 'scale': 0.05, 'decay': 0.1}}}
-                )
-            else:
-                # logger.info('facing aggro: no, could limp: {}'.format(could_limp))
-                pass
-        else:
-            # logger.info('facing aggro: no, contrib short = {}'.format(contrib_short))
-            pass
+        pot_odds = cls.facing_pot_odds(engine, seat)
+        if pot_odds is not None:
+            # facing aggro now?
+            query['bool']['should'].append({'match': {f'{agg_phase}_aggro': {'query': True, 'boost': 4, '_name': f'{agg_phase}_aggro'}}})
+            # what is po now?
+            scoring_functions.append(
+                {'gauss': {f'{agg_field}_po': {'origin': pot_odds, 'scale': 0.05, 'decay': 0.1}}}
+            )
 
         # facing how many rivals? (currently, not historically)
         if agg_turn <= 2:
@@ -236,53 +371,158 @@ class ES:
             }
         }
 
-        sea = GameAction.search()
-        sea = sea.query(function_score)
-        sea = sea.sort('_score', {'created_at': 'desc'})
-
-        # establish which doc field is to be aggregated on for this player
-        docs_per_shard = cls.SAMPLE_SIZE / active_primary_shards
-        # # logger.info('docs per shard = {}'.format(docs_per_shard))
-
-        sample = A('sampler', shard_size=docs_per_shard)
-        terms = A('terms', field=agg_field)
-        # pottie = A('percentiles', field='{}_btp'.format(agg_field), percents=[10, 30, 50, 70, 90])
-        # sea.aggs.bucket('mesam', sample).metric('pottie', pottie).bucket('aksies', terms)
-        sea.aggs.bucket('mesam', sample).bucket('aksies', terms)
-
         # percentile = 50
         # hs_agg = A('percentiles', field='{}_hs'.format(agg_field), percents=[percentile])
         # sea.aggs.bucket('hs', sample).metric('hs_agg', hs_agg)
+        return agg_field, {
+            'function_score': function_score,
+            'sample_size': cls.SAMPLE_SIZE,
+            'terms_field': agg_field,
+            'percentiles_field': f'{agg_field}_btp',
+            'percents': cls.BTP_PERCENTS,
+        }
 
-        sea = sea[:docs_size]
-        res = sea.execute()
-        assert res._shards['failed'] == 0
+    @classmethod
+    def player_stats(cls, engine, seat, docs_size=0):
+        """Action distribution and bet to pot ratios of the player's next action, from the
+        player's profile when there are enough hands, else queried (see stats_request)"""
+        agg_field, request = cls.stats_request(engine, seat)
         if docs_size:
-            return res
+            return cls.backend().sample_aggs(docs_size=docs_size, **request)
+        stats = cls.profile_stats(engine, seat, agg_field)
+        if stats:
+            return stats
+        return cls.scale_stats(*cls.sample_aggs(engine.players[seat]['name'], request))
 
+    @classmethod
+    def players_stats(cls, engine, seats):
+        """player_stats of every seat, the ones without a profile queried together in one
+        batch (a multi search on Elasticsearch)"""
+        stats = {}
+        requests = {}
+        for seat in seats:
+            agg_field, request = cls.stats_request(engine, seat)
+            stats[seat] = cls.profile_stats(engine, seat, agg_field)
+            if not stats[seat]:
+                requests[seat] = request
+        results = cls.sample_aggs_many([engine.players[s]['name'] for s in requests], list(requests.values()))
+        for seat, (terms, phase_btps) in zip(requests, results):
+            stats[seat] = cls.scale_stats(terms, phase_btps)
+        return stats
+
+    @classmethod
+    def scale_stats(cls, terms, phase_btps):
+        """player_stats from the sampled action counts and bet to pot percentiles"""
         # debug
         # cls.analyze_stats(sea, seat, res)
 
         # required to scale now mostly for using fold equity
-        total_docs = sum(pa['doc_count'] for pa in res.aggregations.mesam.aksies.buckets)
-        phase_actions = {a['key']: a['doc_count'] / total_docs for a in res.aggregations.mesam.aksies.buckets}
+        total_docs = max(1, sum(terms.values()))
+        phase_actions = {a: doc_count / total_docs for a, doc_count in terms.items()}
         # logger.info('scaled aggs: {}'.format(phase_actions))
 
-        # phase_btps = res.aggregations.mesam.pottie.values.to_dict()
         # logger.debug('phase_btps {}'.format(phase_btps))
 
-        # clean out NaN
-        # phase_btps = {k: round(v, 2) for k, v in phase_btps.items() if isinstance(v, float)} or {'0.50': 0.50}
-        # logger.debug('cleaned phase_btps {}'.format(phase_btps))
+        btps = cls.order_btps(phase_btps)
+        # logger.debug('cleaned phase_btps {}'.format(btps))
 
         # hand strength
         # hs = res.aggregations['hs']['hs_agg']['values'][f'{percentile}.0']
 
         return {
             'actions': phase_actions,
+            'btps': btps,
             # 'hs': 1 - float(hs),
         }
 
+    @classmethod
+    def order_btps(cls, phase_btps):
+        """Bet to pot ratios by percentile, most likely first: the median, then outwards. Cleans
+        out missing values and duplicates"""
+        btps = []
+        for percent in sorted(cls.BTP_PERCENTS, key=lambda p: abs(p - 50)):
+            btp = phase_btps.get(percent)
+            if btp and btp > 0 and round(btp, 2) not in btps:
+                btps.append(round(btp, 2))
+        return btps
+
+    @staticmethod
+    def street_profile(engine, seat, street, pot_odds):
+        """Profile of the player for the street facing the pot odds, given the player's actions
+        so far"""
+        p = engine.players[seat]
+        d = engine.data[seat]
+        actions = {f'{phase}_{i + 1}': ai['action'] for phase in PHASES for i, ai in enumerate(d[phase][:2])}
+        return player_profiles.get(p['name'], engine.site_name, engine.vs, street, history_prefix(actions, street),
+                                   pot_odds)
+
+    @classmethod
+    def profile_stats(cls, engine, seat, agg_field):
+        """player_stats from the player's profile, None when it has too few docs"""
+        profile = cls.street_profile(engine, seat, agg_field, cls.facing_pot_odds(engine, seat))
+        if not profile:
+            return None
+        actions = Counter(profile['actions'])
+        # blinds are excluded as in the query
+        if agg_field == 'preflop_1':
+            for blind in ['s', 'l']:
+                actions.pop(blind, None)
+        total_docs = sum(actions.values())
+        if total_docs < cls.PROFILE_DOCS:
+            return None
+        btps = {p: PlayerProfiles.quantile('btp', profile['btp'], p, profile['btp_max']) for p in cls.BTP_PERCENTS}
+        return {
+            'actions': {a: doc_count / total_docs for a, doc_count in actions.items()},
+            'btps': cls.order_btps(btps),
+        }
+
+    @staticmethod
+    def agg_street(engine, d):
+        """Phase and turn (1 or 2) of the player's next action"""
+        agg_phase = engine.phase
+        if not d[agg_phase]:
+            return agg_phase, 1
+        if len(d[agg_phase]) < 2:
+            return agg_phase, 2
+        if agg_phase == engine.PHASE_PREFLOP:
+            return engine.PHASE_FLOP, 1
+        if agg_phase == engine.PHASE_FLOP:
+            return engine.PHASE_TURN, 1
+        return engine.PHASE_RIVER, 1
+
+    @staticmethod
+    def facing_pot_odds(engine, seat):
+        """Pot odds of the player when facing aggression now, else None"""
+        p = engine.players[seat]
+        d = engine.data[seat]
+        contribs_all = [pd['contrib'] for pd in engine.data.values()]
+        total_contribs = sum(contribs_all)
+        max_contrib = max(contribs_all)
+        contrib_short = max_contrib - d['contrib']
+        if not contrib_short:
+            # logger.info('facing aggro: no, contrib short = {}'.format(contrib_short))
+            return None
+        could_limp = True if engine.phase == engine.PHASE_PREFLOP and max_contrib == engine.bb_amt else False
+        if could_limp:
+            # logger.info('facing aggro: no, could limp: {}'.format(could_limp))
+            return None
+        balance_left = p['balance'] - d['contrib']
+        return min(balance_left, contrib_short) / max(1, (engine.pot + total_contribs))
+
+    @classmethod
+    def stats_key(cls, engine, seat):
+        """Everything player_stats depends on: the same key gives the same stats. Pot odds are
+        bucketed to a fraction of the gauss scale they are scored with"""
+        p = engine.players[seat]
+        d = engine.data[seat]
+        history = tuple(
+            (phase, tuple((ai['action'], ai['aggro'] if i == 0 else None, ai['rvl'] if i <= 1 else None)
+                         for i, ai in enumerate(d[phase])))
+            for phase in ['preflop', 'flop', 'turn', 'river'])
+        pot_odds = cls.facing_pot_odds(engine, seat)
+        po_bucket = None if pot_odds is None else round(pot_odds / cls.PO_BUCKET)
+        return (p['name'], engine.site_name, engine.vs, engine.rivals, history, cls.agg_street(engine, d), po_bucket)
+
     @classmethod
     def showdown_hs(cls, engine, seat, docs_size=0, percentile=50):
         """Get the stats for the history of the seat."""
@@ -314,6 +554,8 @@ class ES:
                     phase_matching.append({'match': {f'{phase}_aggro': {'query': action_info['aggro'], 'boost': 4, '_name': f'{phase}_aggro'}}})
                 if i <= 1:
                     street_name = f'{phase}_{i+1}'
+                    street_action = action_info['action']
+                    street_pot_odds = action_info.get('pot_odds')
                     # phase_matching.append({'match': {f'{street_name}_rvl': {'query': action_info['rvl'], 'boost': 2, '_name': f'{street_name}_rvl'}}})
                     # scoring_functions.append(
                     #     {'gauss': {f'{street_name}_rvl': {'origin': action_info['rvl'], 'scale': 1, 'decay': 0.20}}}
@@ -326,6 +568,13 @@ class ES:
                 phase_matching.append({'match': {f'{phase}_{i+1}': {'query': action_info['action'], 'boost': 10, '_name': f'{phase}_{i+1}'}}})
         query['bool']['should'].extend(phase_matching)
 
+        # the player's profile when there are enough hands, else query
+        if not docs_size:
+            profile = cls.street_profile(engine, seat, street_name, street_pot_odds)
+            hs = profile['hs'].get(street_action) if profile else None
+            if hs is not None and hs.sum() >= cls.PROFILE_DOCS:
+                return PlayerProfiles.quantile('hs', hs, percentile)
+
         # add hs function score
         # function_score['function_score']['functions'].append(
         #     {'linear': {f'{street_name}_hs': {'origin': 1, 'scale': 0.01, 'decay': 0.01}}, 'weight': 3},
@@ -341,28 +590,20 @@ class ES:
             }
         }
 
-        sea = GameAction.search()
-        sea = sea.query(function_score)
-        sea = sea.sort('_score', {'created_at': 'desc'})
-
-        # establish which doc field is to be aggregated on for this player
-        docs_per_shard = (cls.SAMPLE_SIZE / 10) / active_primary_shards
-
         # CURRENT
         # get latest field
-        sample = A('sampler', shard_size=docs_per_shard)
-        hs_agg = A('percentiles', field=f'{street_name}_hs', percents=[percentile])
-        sea.aggs.bucket('hs', sample).metric('hs_agg', hs_agg)
-
-        sea = sea[:docs_size]
-        res = sea.execute()
-        assert res._shards['failed'] == 0
+        request = {
+            'function_score': function_score,
+            'sample_size': cls.SAMPLE_SIZE / 10,
+            'percentiles_field': f'{street_name}_hs',
+            'percents': [percentile],
+        }
         if docs_size:
-            return res
+            return cls.backend().sample_aggs(docs_size=docs_size, **request)
 
         # hand strength
-        hs = res.aggregations['hs']['hs_agg']['values'][f'{percentile}.0']
-        return float(hs) if hs != 'NaN' else 0.50
+        hs = cls.sample_aggs(p['name'], request)[1][percentile]
+        return hs if hs is not None else 0.50
 
     @classmethod
     def analyze_stats(cls, sea, seat, res=None):
@@ -459,10 +700,18 @@ class ES:
         return r
 
     @classmethod
-    def save_game(self, players, data, site_name, vs, board):
+    def save_game(cls, players, data, site_name, vs, board):
+        """Queues the docs of the game to be written by the game writer. The engine data is
+        copied, the docs (and hand strengths) are made on the writer thread."""
         logger.info('saving game...')
+        game_writer.put(partial(cls.game_docs, deepcopy(players), deepcopy(data), site_name, vs, list(board),
+                                datetime.datetime.utcnow()))
+
+    @classmethod
+    def game_docs(cls, players, data, site_name, vs, board, created_at):
         names_and_balances = ''.join([f'{p["name"]}{p["balance"]}' for p in players.values()])
         logger.debug(f'names and balances: {names_and_balances}')
+        docs = []
         for s, d in data.items():
             if d['sitout']:
                 continue
@@ -483,7 +732,7 @@ class ES:
                     if d['hand'] and d['hand'] not in [['  ', '  '], ['__', '__']]:
                         logger.info(f'do hand ranking of {d["hand"]}')
                         if phase == 'river':
-                            hs_board = board
+                            hs_board = board[:5]
                         elif phase == 'turn':
                             hs_board = board[:4]
                         elif phase == 'flop':
@@ -499,34 +748,44 @@ class ES:
                     'player': players[s]['name'],
                     'site': site_name,
                     'vs': vs,
-                    'created_at': datetime.datetime.utcnow(),
+                    'created_at': created_at,
                 })
                 logger.info(f'saving doc: {json.dumps(doc, indent=3, default=str)}')
-                GameAction(**doc).save()
+                docs.append(doc)
+        return docs
+
+    @classmethod
+    def save_doc(cls, doc):
+        """Queues the game action doc to be written"""
+        game_writer.put(lambda: [doc])
+
+    @classmethod
+    def write_docs(cls, docs):
+        """Saves the docs in one batch, counts the saved ones into the players' profiles and drops
+        the players' cached query results. Returns the docs that were not saved"""
+        saved = cls.backend().save_many(docs)
+        for doc in saved:
+            player_profiles.add(doc)
+        for player in {doc['player'] for doc in saved}:
+            query_cache.invalidate(player)
+        saved = {id(doc) for doc in saved}
+        return [doc for doc in docs if id(doc) not in saved]
 
     @classmethod
     def most_frequent_players(cls):
         logger.info('getting most frequent players')
-        sea = GameAction.search()
-        players_terms = A('terms', field='player')
-        sea.aggs.bucket('players', players_terms)
-        sea = sea[:0]
-        res = sea.execute()
-        # print(repr(res.aggregations['players']['buckets']))
-        for item in res.aggregations['players']['buckets']:
-            print('{}: {}'.format(item['key'], item['doc_count']))
+        for player, doc_count in cls.backend().player_counts():
+            print('{}: {}'.format(player, doc_count))
 
     @classmethod
     def delete_player(cls, player_name):
         logger.info('delete player docs')
-        q = Q('bool', must=Q('match', player=player_name))
-        sea = GameAction.search()
-        sea = sea.query(q)
+        deleted = cls.backend().delete_player(player_name)
+        query_cache.invalidate(player_name)
+        logger.info(f'deleted {deleted} docs of {player_name}')
 
-        res = sea.execute()
-        print(res.hits.total)
-        time.sleep(3)
 
-        for hit in sea.scan():
-            print(hit['player'], hit._id)
-            hit.delete()
+query_cache = QueryCache(ES.QUERY_CACHE_SIZE, ES.QUERY_CACHE_TTL)
+
+game_writer = GameWriter(ES.write_docs)
+atexit.register(game_writer.flush, GameWriter.FLUSH_TIMEOUT)
@@ -0,0 +1,229 @@
+from collections import Counter
+import datetime
+import json
+import logging
+from math import log
+from os.path import dirname, realpath, join
+import sqlite3
+from threading import Lock
+import uuid
+
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+
+PHASES = ['preflop', 'flop', 'turn', 'river']
+STRING_FIELDS = ['site', 'game', 'player'] + [f'{phase}_{i}' for phase in PHASES for i in (1, 2)]
+NUMBER_FIELDS = ['vs', 'amount', 'pot', 'pos'] + \
+    [f'{phase}_{i}_{m}' for phase in PHASES for i in (1, 2) for m in ('btp', 'po', 'rvl', 'hs')] + \
+    [f'{phase}_aggro' for phase in PHASES] + ['created_at']
+
+
+class LocalStore:
+    """Game actions in SQLite, scored in memory with NumPy. Needs no service.
+
+    Evaluates the part of the function_score DSL that the ES queries use:
+    - bool should: match (adds its boost when the field equals the query) and exists (adds 1).
+      As in ES, only docs matching at least one should clause are kept.
+    - bool must_not: term.
+    - linear, gauss and exp decay functions, 1 when the field is missing. They are added
+      together and onto the query score (score_mode and boost_mode sum).
+    Unlike Lucene a match scores exactly its boost, there is no tf-idf. Booleans are stored as
+    0/1 and created_at as a timestamp.
+    """
+
+    FILE = join(dirname(realpath(__file__)), 'game_actions.db')
+
+    def __init__(self, path=FILE):
+        self.path = path
+        self.lock = Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        columns = ', '.join([f'{f} TEXT' for f in STRING_FIELDS] + [f'{f} REAL' for f in NUMBER_FIELDS])
+        self.conn.execute(f'CREATE TABLE IF NOT EXISTS game_actions (_id TEXT PRIMARY KEY, {columns})')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS game_actions_player ON game_actions (player)')
+        self.columns = None
+
+    def load(self):
+        """Every doc as numpy columns: objects (None if missing) for strings, floats (nan if
+        missing) for numbers. Kept till the next write."""
+        with self.lock:
+            if self.columns is None:
+                fields = ['_id'] + STRING_FIELDS + NUMBER_FIELDS
+                rows = self.conn.execute(f'SELECT {", ".join(fields)} FROM game_actions').fetchall()
+                columns = {}
+                for i, f in enumerate(fields):
+                    values = [r[i] for r in rows]
+                    if f in NUMBER_FIELDS:
+                        columns[f] = np.array([np.nan if v is None else v for v in values], dtype=np.float64)
+                    else:
+                        columns[f] = np.array(values, dtype=object)
+                self.columns = columns
+            return self.columns
+
+    @staticmethod
+    def encode(value):
+        if isinstance(value, bool):
+            return int(value)
+        if isinstance(value, datetime.datetime):
+            return value.replace(tzinfo=datetime.timezone.utc).timestamp()
+        return value
+
+    def save(self, doc):
+        self.save_many([doc])
+
+    def save_many(self, docs):
+        """Inserts the docs in one transaction, replacing those with the same _id. Fields that
+        are not mapped are dropped. Returns the docs, all are saved or none"""
+        rows = []
+        for doc in docs:
+            doc = dict(doc)
+            doc.setdefault('_id', uuid.uuid4().hex)
+            fields = [f for f in ['_id'] + STRING_FIELDS + NUMBER_FIELDS if f in doc]
+            # only the first two actions of a phase are stored (ES maps the rest dynamically),
+            # queries on later ones find them missing
+            unknown = set(doc) - set(fields)
+            if unknown:
+                logger.debug(f'not storing game action fields {unknown}')
+            rows.append((fields, [self.encode(doc[f]) for f in fields]))
+        with self.lock:
+            with self.conn:
+                for fields, values in rows:
+                    self.conn.execute('INSERT OR REPLACE INTO game_actions ({}) VALUES ({})'.format(
+                        ', '.join(fields), ', '.join('?' * len(fields))), values)
+            self.columns = None
+        return docs
+
+    def clause(self, columns, clause):
+        """Score of every doc for a query clause, 0 where it does not match. Fields that are not
+        stored are missing in every doc, as in ES for a field no doc has"""
+        (kind, spec), = clause.items()
+        if kind == 'exists':
+            if spec['field'] not in columns:
+                return np.zeros(len(columns['_id']))
+            return self.present(columns[spec['field']]).astype(np.float64)
+        (field, value), = spec.items()
+        boost = 1
+        if isinstance(value, dict):
+            boost = value.get('boost', 1)
+            value = value['query'] if kind == 'match' else value['value']
+        if kind not in ('match', 'term'):
+            raise ValueError(f'query clause {kind} is not supported')
+        if field not in columns:
+            return np.zeros(len(columns['_id']))
+        column = columns[field]
+        if column.dtype == object:
+            matches = column == value
+        else:
+            matches = column == self.encode(value)
+        return boost * matches.astype(np.float64)
+
+    @staticmethod
+    def present(column):
+        if column.dtype == object:
+            return np.array([v is not None for v in column], dtype=bool)
+        return ~np.isnan(column)
+
+    @staticmethod
+    def decay(kind, column, origin, scale, decay=0.5, offset=0):
+        """ES decay function of a numeric field, 1 where the field is missing"""
+        distance = np.maximum(0, np.abs(column - origin) - offset)
+        if kind == 'linear':
+            s = scale / (1 - decay)
+            values = np.maximum(0, (s - distance) / s)
+        elif kind == 'gauss':
+            sigma2 = -scale ** 2 / (2 * log(decay))
+            values = np.exp(-distance ** 2 / (2 * sigma2))
+        elif kind == 'exp':
+            values = np.exp(log(decay) / scale * distance)
+        else:
+            raise ValueError(f'score function {kind} is not supported')
+        return np.where(np.isnan(column), 1, values)
+
+    def score(self, function_score, columns=None, memo=None):
+        """(scores, matching) of every doc in the columns (loaded now if not given) for a
+        function_score query. Clause and function scores are kept in the memo, if given, for the
+        queries on the same columns that share them"""
+        function_score = function_score['function_score']
+        if function_score.get('score_mode', 'sum') != 'sum' or function_score.get('boost_mode', 'sum') != 'sum':
+            raise ValueError('only the sum score and boost modes are supported')
+        if columns is None:
+            # a memo holds scores of the columns it was filled with
+            columns, memo = self.load(), None
+        n = len(columns['_id'])
+        query = function_score['query']['bool']
+        scores = np.zeros(n)
+        matching = np.zeros(n, dtype=bool)
+        memo = {} if memo is None else memo
+
+        def memoized(f, spec):
+            key = json.dumps(spec, sort_keys=True, default=str)
+            if key not in memo:
+                memo[key] = f(spec)
+            return memo[key]
+
+        for clause in query.get('should', []):
+            clause_scores = memoized(lambda c: self.clause(columns, c), clause)
+            scores += clause_scores
+            matching |= clause_scores > 0
+        for clause in query.get('must_not', []):
+            matching &= memoized(lambda c: self.clause(columns, c), clause) == 0
+        for function in function_score.get('functions', []):
+            scores += memoized(lambda f: self.function(columns, f), function)
+        return scores, matching
+
+    def function(self, columns, function):
+        weight = function.get('weight', 1)
+        (kind, spec), = ((k, v) for k, v in function.items() if k != 'weight')
+        (field, params), = spec.items()
+        # a missing field decays to 1
+        column = columns.get(field, np.full(len(columns['_id']), np.nan))
+        return weight * self.decay(kind, column, **params)
+
+    def sample_aggs(self, function_score, sample_size, terms_field=None, percentiles_field=None, percents=(),
+                    docs_size=0, columns=None, memo=None):
+        """Terms counts and percentiles over the sample_size best scoring docs (newest first on
+        equal scores). With docs_size the best docs are returned instead."""
+        if columns is None:
+            columns, memo = self.load(), None
+        scores, matching = self.score(function_score, columns, memo)
+        idx = np.nonzero(matching)[0]
+        created_at = np.nan_to_num(columns['created_at'][idx])
+        order = idx[np.lexsort((-created_at, -scores[idx]))]
+        if docs_size:
+            return [dict({f: c[i] for f, c in columns.items()}, _score=scores[i]) for i in order[:docs_size]]
+        sample = order[:int(sample_size)]
+
+        terms = {}
+        if terms_field in columns:
+            column = columns[terms_field][sample]
+            terms = dict(Counter(v for v in column if v is not None).most_common())
+
+        percentiles = {}
+        if percentiles_field:
+            values = columns[percentiles_field][sample] if percentiles_field in columns else np.array([])
+            values = values[~np.isnan(values)]
+            for p in percents:
+                percentiles[p] = float(np.percentile(values, p)) if len(values) else None
+        return terms, percentiles
+
+    def sample_aggs_many(self, requests):
+        """sample_aggs of every request (a dict of its arguments) as one grouped query: the docs
+        are loaded once and the clauses the requests share (site, vs) are scored once. Docs saved
+        meanwhile are left to the next query"""
+        columns = self.load()
+        memo = {}
+        return [self.sample_aggs(columns=columns, memo=memo, **request) for request in requests]
+
+    def player_counts(self):
+        """(player, docs) most docs first"""
+        return self.conn.execute(
+            'SELECT player, COUNT(*) FROM game_actions GROUP BY player ORDER BY COUNT(*) DESC').fetchall()
+
+    def delete_player(self, player_name):
+        with self.lock:
+            with self.conn:
+                deleted = self.conn.execute('DELETE FROM game_actions WHERE player = ?', (player_name,)).rowcount
+            self.columns = None
+        return deleted
@@ -0,0 +1,149 @@
+import atexit
+from collections import Counter
+import json
+import logging
+from os.path import dirname, realpath, join
+import shelve
+from threading import Lock
+
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+
+PHASES = ['preflop', 'flop', 'turn', 'river']
+STREETS = [f'{phase}_{i}' for phase in PHASES for i in (1, 2)]
+
+
+def history_prefix(actions, street):
+    """The actions (by street) before the street, '.' where the player did not act"""
+    return ''.join(actions.get(s, '.') for s in STREETS[:STREETS.index(street)])
+
+
+class PlayerProfiles:
+    """Action frequencies per player, site, vs bucket, street, the player's actions before it and
+    the pot odds faced (bucketed, None when not facing aggression).
+
+    A profile holds the action counts, a btp histogram and hs histograms per action (as quantile
+    sketches). Profiles are updated with every saved doc and kept in a shelve, together with the
+    _ids of the docs counted: a doc saved again replaces the stored one, so it is not counted twice.
+    """
+
+    FILE = join(dirname(realpath(__file__)), 'profiles')
+    # lower bounds of the vs buckets: heads up, short handed, full ring
+    VS_BUCKETS = [2, 3, 7]
+    # lower bounds of the pot odds buckets: small bets, half to two thirds pot, pot, overbets
+    PO_BUCKETS = [0, 0.2, 0.3, 0.4]
+    # (low, high, bins) of the histograms, values from high up count in an extra overflow bin
+    BINS = {
+        'btp': (0, 3, 60),
+        'hs': (0, 1, 100),
+    }
+
+    def __init__(self, path=FILE):
+        self.path = path
+        self.lock = Lock()
+        self.shelf = None
+        self.cache = {}
+
+    def open(self):
+        if self.shelf is None:
+            self.shelf = shelve.open(self.path)
+        return self.shelf
+
+    def close(self):
+        with self.lock:
+            if self.shelf is not None:
+                self.shelf.close()
+                self.shelf = None
+
+    @classmethod
+    def vs_bucket(cls, vs):
+        return max(b for b in cls.VS_BUCKETS if b <= max(vs, cls.VS_BUCKETS[0]))
+
+    @classmethod
+    def po_bucket(cls, pot_odds):
+        if pot_odds is None:
+            return None
+        return max(b for b in cls.PO_BUCKETS if b <= pot_odds)
+
+    @classmethod
+    def key(cls, player, site, vs, street, prefix, pot_odds):
+        return json.dumps([player, site, cls.vs_bucket(vs), street, prefix, cls.po_bucket(pot_odds)])
+
+    @staticmethod
+    def seen_key(doc_id):
+        return json.dumps(['_id', doc_id])
+
+    @classmethod
+    def histogram(cls, field):
+        return np.zeros(cls.BINS[field][2] + 1, dtype=np.int64)
+
+    @classmethod
+    def new_profile(cls):
+        return {
+            'docs': 0,
+            'actions': Counter(),
+            'btp': cls.histogram('btp'),
+            # the largest btp seen, what the overflow bin stands for
+            'btp_max': 0.,
+            'hs': {},
+        }
+
+    @classmethod
+    def bin(cls, field, value):
+        low, high, bins = cls.BINS[field]
+        if value >= high:
+            return bins
+        return max(0, int((value - low) / (high - low) * bins))
+
+    @classmethod
+    def quantile(cls, field, histogram, percent, overflow=None):
+        """Value at the percentile of the field's histogram (bin middles), None if empty. The
+        overflow bin is valued at overflow, else at the high end of the range"""
+        total = histogram.sum()
+        if not total:
+            return None
+        low, high, bins = cls.BINS[field]
+        i = int(np.searchsorted(np.cumsum(histogram), total * percent / 100))
+        if i >= bins:
+            return high if overflow is None else overflow
+        return low + (i + 0.5) * (high - low) / bins
+
+    def get(self, player, site, vs, street, prefix, pot_odds):
+        key = self.key(player, site, vs, street, prefix, pot_odds)
+        with self.lock:
+            if key not in self.cache:
+                self.cache[key] = self.open().get(key)
+            return self.cache[key]
+
+    def add(self, doc):
+        """Counts the streets of a saved doc into their profiles"""
+        actions = {s: doc[s] for s in STREETS if s in doc}
+        with self.lock:
+            shelf = self.open()
+            if doc.get('_id') is not None:
+                seen = self.seen_key(doc['_id'])
+                if seen in shelf:
+                    logger.debug(f'doc {doc["_id"]} is already in the profiles')
+                    return
+                shelf[seen] = True
+            for street, action in actions.items():
+                key = self.key(doc['player'], doc['site'], doc['vs'], street, history_prefix(actions, street),
+                               doc.get(f'{street}_po'))
+                profile = self.cache.get(key) or shelf.get(key) or self.new_profile()
+                profile['docs'] += 1
+                profile['actions'][action] += 1
+                if doc.get(f'{street}_btp') is not None:
+                    profile['btp'][self.bin('btp', doc[f'{street}_btp'])] += 1
+                    profile['btp_max'] = max(profile['btp_max'], doc[f'{street}_btp'])
+                if doc.get(f'{street}_hs') is not None:
+                    hs = profile['hs'].setdefault(action, self.histogram('hs'))
+                    hs[self.bin('hs', doc[f'{street}_hs'])] += 1
+                self.cache[key] = profile
+                shelf[key] = profile
+
+
+player_profiles = PlayerProfiles()
+atexit.register(player_profiles.close)
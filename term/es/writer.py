@@ -0,0 +1,139 @@
+import logging
+import os
+from queue import Queue, Empty, Full
+from threading import Thread, Lock
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class GameWriter:
+    """Write-behind queue of game action docs.
+
+    Jobs are callables returning docs, so building them (hand strengths included) happens on the
+    background thread as well. The thread takes whatever jobs are queued, up to BATCH_SIZE, and
+    hands all their docs to the write function in one go. The write function returns the docs it
+    could not write, those are retried with a growing wait before they are dropped. The queue is
+    bounded: when it is full the caller waits, which shows up as blocked in the info.
+    """
+
+    BATCH_SIZE = 64
+    MAX_QUEUE = 1 << 10
+    # retries of docs that could not be written, the first after RETRY_WAIT seconds, doubling
+    RETRIES = 3
+    RETRY_WAIT = 0.5
+    # seconds to wait for queued games at exit
+    FLUSH_TIMEOUT = 10
+
+    def __init__(self, write):
+        self.write = write
+        self.queue = Queue(self.MAX_QUEUE)
+        self.lock = Lock()
+        self.writer = None
+        self.writer_pid = None
+        self.stats = {
+            'jobs': 0,
+            'batches': 0,
+            'docs': 0,
+            'errors': 0,
+            'retries': 0,
+            'dropped': 0,
+            'blocked': 0,
+            'max_depth': 0,
+            'write_time': 0.,
+            'max_write_time': 0.,
+            'max_lag': 0.,
+        }
+
+    def put(self, job):
+        """Queues the job, waiting only when the queue is full"""
+        if self.writer_pid != os.getpid():
+            self.writer = Thread(target=self.write_loop, name='game-writer', daemon=True)
+            self.writer.start()
+            self.writer_pid = os.getpid()
+        item = (time.time(), job)
+        try:
+            self.queue.put_nowait(item)
+        except Full:
+            with self.lock:
+                self.stats['blocked'] += 1
+            logger.warning(f'game writer queue is full ({self.MAX_QUEUE} jobs)')
+            self.queue.put(item)
+        with self.lock:
+            self.stats['jobs'] += 1
+            self.stats['max_depth'] = max(self.stats['max_depth'], self.queue.qsize())
+
+    def write_loop(self):
+        while True:
+            items = [self.queue.get()]
+            try:
+                while len(items) < self.BATCH_SIZE:
+                    items.append(self.queue.get_nowait())
+            except Empty:
+                pass
+            start = time.time()
+            try:
+                docs = []
+                for _, job in items:
+                    try:
+                        docs.extend(job())
+                    except Exception as e:
+                        logger.exception(f'could not build the docs of a queued game: {e}')
+                        with self.lock:
+                            self.stats['errors'] += 1
+                failed = self.write_docs(docs) if docs else []
+                done = time.time()
+                with self.lock:
+                    self.stats['batches'] += 1
+                    self.stats['docs'] += len(docs) - len(failed)
+                    self.stats['dropped'] += len(failed)
+                    self.stats['write_time'] += done - start
+                    self.stats['max_write_time'] = max(self.stats['max_write_time'], done - start)
+                    self.stats['max_lag'] = max(self.stats['max_lag'], done - items[0][0])
+                logger.debug(f'wrote {len(docs) - len(failed)} docs of {len(items)} games in {done - start:.3f}s')
+            finally:
+                for _ in items:
+                    self.queue.task_done()
+
+    def write_docs(self, docs):
+        """Writes the docs, retrying the ones that failed. Returns the docs that were dropped"""
+        for retry in range(self.RETRIES + 1):
+            if retry:
+                time.sleep(self.RETRY_WAIT * 2 ** (retry - 1))
+                with self.lock:
+                    self.stats['retries'] += 1
+            try:
+                docs = self.write(docs)
+            except Exception as e:
+                logger.exception(f'could not write {len(docs)} docs: {e}')
+                with self.lock:
+                    self.stats['errors'] += 1
+            if not docs:
+                return []
+        logger.error(f'dropped {len(docs)} docs after {self.RETRIES} retries')
+        return docs
+
+    def flush(self, timeout=None):
+        """Waits for queued games to be written, at most timeout seconds when given. True when
+        all were written"""
+        if self.writer_pid != os.getpid():
+            return True
+        deadline = None if timeout is None else time.time() + timeout
+        with self.queue.all_tasks_done:
+            while self.queue.unfinished_tasks:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    logger.warning(f'{self.queue.unfinished_tasks} queued games not written')
+                    return False
+                self.queue.all_tasks_done.wait(remaining)
+        return True
+
+    def info(self):
+        """Queue depth and write counters, times in ms"""
+        with self.lock:
+            info = dict(self.stats, depth=self.queue.qsize())
+        info['mean_write_time'] = info['write_time'] / info['batches'] * 1000 if info['batches'] else 0
+        for k in ['write_time', 'max_write_time', 'max_lag']:
+            info[k] *= 1000
+        return info
@@ -7,7 +7,7 @@ import random
 import retrace
 from string import ascii_uppercase, digits
 
-from es.es import GameAction
+from es.es import ES
 from engine.engine import Engine
 from mc.mc import MonteCarlo
 
@@ -118,7 +118,7 @@ class Game:
                     'vs': self.engine.vs,
                     'created_at': datetime.datetime.utcnow(),
                 })
-                GameAction(**doc).save()
+                ES.save_doc(doc)
                 logger.info('saved {}'.format(doc))
 
     def undo(self):
@@ -0,0 +1,74 @@
+from collections import OrderedDict
+import logging
+from threading import Lock
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class LRUCache:
+    """Bounded LRU of values by key with hit rates, and optionally a TTL (seconds) after which
+    entries expire. Safe to share between threads."""
+
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.lock = Lock()
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key):
+        """The value, None if missing or expired"""
+        with self.lock:
+            try:
+                expires, value = self.data[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            if expires is not None and expires < time.time():
+                del self.data[key]
+                self.expired += 1
+                self.misses += 1
+                return None
+            self.data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.data[key] = (time.time() + self.ttl if self.ttl else None, value)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+                self.evicted += 1
+
+    def remove_if(self, predicate):
+        """Removes the entries for which predicate(key, value) is true, returns how many"""
+        with self.lock:
+            keys = [k for k, (_, v) in self.data.items() if predicate(k, v)]
+            for k in keys:
+                del self.data[k]
+        return len(keys)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def info(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0,
+            'expired': self.expired,
+            'evicted': self.evicted,
+            'size': len(self.data),
+            'maxsize': self.maxsize,
+        }
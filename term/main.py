@@ -21,6 +21,24 @@ def rankings():
 cli.add_command(rankings)
 
 
+@click.command()
+def preflop():
+    click.echo('preflop')
+    from pocket_rankings.pocket_rankings import PocketRankings
+    PocketRankings.run_preflop()
+cli.add_command(preflop)
+
+
+@click.command()
+@click.option('--duration', default=5, help='seconds per benchmark')
+def bench(duration):
+    click.echo('bench')
+    from pe.pe import benchmark
+    for name, rate in benchmark(duration).items():
+        click.echo('{}: {:.1f}'.format(name, rate))
+cli.add_command(bench)
+
+
 @click.command()
 def table():
     click.echo('table')
@@ -34,10 +52,12 @@ cli.add_command(table)
 @click.option('--profile', is_flag=True, help='cprofile app for performance')
 @click.option('--observe', is_flag=True, help='will not run mc')
 @click.option('--replay', is_flag=True, help='will reuse saved images')
+@click.option('--procs', default=1, help='processes searching the mc tree')
+@click.option('--anytime', is_flag=True, help='keeps the mc searching in the background')
 @click.argument('site')
 @click.argument('seats', type=click.INT)
 @click.pass_context
-def scrape(ctx, site, seats, replay, observe, profile):
+def scrape(ctx, site, seats, replay, observe, profile, procs, anytime):
     debug = ctx.obj['debug']
     # change logging based on debug
     if not debug:
@@ -45,7 +65,8 @@ def scrape(ctx, site, seats, replay, observe, profile):
         for hdlr in logger.handlers:
             hdlr.setLevel(logging.INFO)
     from scraper.main import Scraper
-    scraper = Scraper(site, seats, debug=debug, replay=replay, observe=observe)
+    scraper = Scraper(site, seats, debug=debug, replay=replay, observe=observe, procs=procs,
+                      anytime=anytime)
     if profile:
         cProfile.runctx('scraper.run()', globals(), locals(), 'stats.prof')
     else:
@@ -1,23 +1,26 @@
 from collections import deque, Counter, defaultdict
 from copy import deepcopy
+from functools import lru_cache
 import hashlib
+import heapq
 import json
 import logging
+from math import sqrt
+import multiprocessing
 from operator import itemgetter
 from queue import Queue, Empty, PriorityQueue
 from threading import Thread, Lock
 from concurrent.futures import ThreadPoolExecutor
 
-import retrace
-import shelve
 import time
 
 import sys
-from treelib import Tree
-import uuid
 
+from engine.channel import engine_channel
 from engine.engine import Engine, ACTIONS_TO_ABBR
 from es.es import ES
+from lru import LRUCache
+from mc.tree import ArrayTree
 from pe.pe import PE
 
 
@@ -26,21 +29,52 @@ logger = logging.getLogger(__name__)
 
 class MonteCarlo:
     N_THREADS = 1
+    # Processes searching the root, each its own share of the root's children; their root stats
+    # are merged
+    N_PROCS = 1
     PERCENTILE = 100
-
-    def __init__(self, engine=None, hero=None):
+    # Node selection: 'probable' expands the most probable untraversed node once,
+    # 'puct' descends from the root every time, revisiting nodes with the action stats as priors
+    POLICY = 'probable'
+    # PUCT exploration, in big blinds
+    PUCT_C = 1.5
+    # Leaf EVs shared between nodes reaching the same state
+    TRANSPOSITIONS = 1 << 16
+    # ES stats shared between nodes with the same stats key, for the hand
+    STATS_MEMO = 1 << 12
+    # Progressive widening: bets and raises start with the most likely size from the ES btp
+    # percentiles, a node gets up to WIDEN_K * (traversed + 1) ** WIDEN_ALPHA sizes where
+    # traversed counts the leaves reached below it
+    WIDENING = False
+    WIDEN_K = 1
+    WIDEN_ALPHA = 0.5
+    # observed bets further than this fraction off the closest node's size get a node of their own
+    OFF_SIZE = 0.25
+    # seconds searched by the watcher between checks for a new engine state
+    WATCH_SLICE = 0.1
+
+    def __init__(self, engine=None, hero=None, procs=None, part=None):
+        self.procs = procs or self.N_PROCS
+        # (index, parts): only the root children whose action hashes to index % parts are searched
+        # (see owns)
+        self.part = part or (0, self.procs)
         # self.last_ev = 0
         # self.rolling_10 = deque(maxlen=10)
         # self.rolling_40 = deque(maxlen=40)
         self.ev_history = {}
+        self.engine = None
         self.time_start = None
         self.duration = None
-        self.queue = None
+        self.frontier = None
+        self.frontier_ids = None
         self.leaf_path = None
+        self.sim = None
+        self.sim_snapshot = None
+        self.transpositions = LRUCache(self.TRANSPOSITIONS)
+        self.stats_memo = LRUCache(self.STATS_MEMO)
 
         if not engine:
-            # logger.info('engine not given, loading from file...')
-            self.engine_checksum = None
+            # logger.info('engine not given, loading from channel...')
             self.load_engine(hero)
         else:
             # logger.info('engine given')
@@ -48,22 +82,60 @@ class MonteCarlo:
 
     @property
     def current_actions(self):
-        return [(c.data['action'], c.data['ev'], c.data['traversed'])
-                for c in self.tree.children(self.tree.root)]
+        """(action, ev, traversed) of the root children, including what the workers found"""
+        tree = self.tree
+        actions = []
+        for c in tree.children(tree.root):
+            action, ev, traversed = tree.action_name(c), tree.ev[c], tree.traversed[c]
+            ev_sum, traversed_workers = self.root_merged.get(action, (0, 0))
+            if traversed_workers:
+                ev = (ev * traversed + ev_sum) / (traversed + traversed_workers)
+                traversed += traversed_workers
+            actions.append((action, ev, traversed))
+        return actions
+
+    def root_stats(self):
+        """ev and traversed per action of the traversed root children"""
+        tree = self.tree
+        return {tree.action_name(c): (tree.ev[c], tree.traversed[c])
+                for c in tree.children(tree.root) if tree.traversed[c]}
+
+    def reroot(self, nid):
+        """Continues from the node after its action was taken, keeping its subtree and the
+        frontier nodes in it"""
+        new_ids = self.tree.reroot(nid)
+        self.frontier = [(priority, new_ids[n]) for priority, n in self.frontier if n in new_ids]
+        heapq.heapify(self.frontier)
+        self.frontier_ids = {n for _, n in self.frontier}
+        self.widening = {new_ids[n]: sizes for n, sizes in self.widening.items() if n in new_ids}
+        self.root_merged = {}
+        # an action the tree did not have yet
+        if self.tree.is_leaf(self.tree.root) and not self.tree.traversed[self.tree.root]:
+            self.push_frontier(self.tree.root)
+
+    def push_frontier(self, nid):
+        """Queues the untraversed node, most probable (highest cum_stats) first"""
+        if self.POLICY == 'probable' and nid not in self.frontier_ids:
+            heapq.heappush(self.frontier, (1 - self.tree.cum_stats[nid], nid))
+            self.frontier_ids.add(nid)
 
     def is_time_left(self):
         return time.time() - self.time_start < self.duration
 
-    @retrace.retry(on_exception=(EOFError, KeyError), interval=0.1, limit=None)
-    def load_engine(self, hero):
-        with shelve.open(Engine.FILE) as shlv:
-            if shlv['hash'] != self.engine_checksum:
-                # logger.info('loading engine from file...')
-                self.engine_checksum = shlv['hash']
-                self.init(shlv['engine'], hero)
+    def load_engine(self, hero, wait=True):
+        """Starts on the engine state the game published last, if it changed"""
+        engine = engine_channel.wait() if wait else engine_channel.receive()
+        if engine is not None:
+            # logger.info('loading engine from channel...')
+            self.init(engine, hero)
 
     def init(self, engine, hero):
         # logger.info('init state')
+        if engine is not self.engine:
+            # a new hand (or an undo): the leaf EVs were of other pockets and the stats are of
+            # the hand, new docs may have been saved since
+            self.transpositions.clear()
+            self.stats_memo.clear()
         self.engine = engine
         self.hero = hero or self.engine.q[0][0]
         self.hero_pocket = self.engine.data[self.hero]['hand']
@@ -77,54 +149,53 @@ class MonteCarlo:
     def init_tree(self):
         """create the tree. Add a root; available action will add the first level of children"""
         # self.traversed_ceiling = 1
-        self.tree = Tree()
-        root = self.tree.create_node('root', identifier='root', data={'traversed': 0, 'ev': 0, 'stats': 1, 'cum_stats': 1})
+        self.tree = ArrayTree()
+        # untraversed nodes to run, kept between runs; traversed entries are dropped when popped
+        self.frontier = []
+        self.frontier_ids = set()
+        self.push_frontier(self.tree.root)
+        # bet and raise sizes still to add per node, by action
+        self.widening = {}
+        # root child stats from worker processes
+        self.root_merged = {}
         # # logger.info('tree:\n{}'.format(self.tree.show()))
         # input('new tree')
 
     def watch(self):
-        """Runs when engine file changes. Just kicks off run for 3s sprints"""
-        # logger.info('Monte Carlo watching every {}s...'.format(self.timeout))
+        """Searches the engine the game publishes in short runs, picking up every new state
+        in between. While there is nothing to search it blocks till the next state."""
+        # logger.info('Monte Carlo watching every {}s...'.format(self.WATCH_SLICE))
         while True:
 
-            # loads new engine file if checksum changed
-            self.load_engine()
+            # new engine state from the game
+            self.load_engine(self.hero, wait=False)
 
             # do not analyze if game finished
             if self.engine.phase in [self.engine.PHASE_SHOWDOWN, self.engine.PHASE_GG]:
-                if not self.watched:
-                    # logger.error('game is finished')
-                    self.watched = True
-                time.sleep(3)
-                continue
+                idle = 'game is finished'
 
             # do not analyze if hero does not have pocket
-            if self.hero_pocket in [['__', '__'], ['  ', '  ']]:
-                if not self.watched:
-                    # logger.error('hero does not have a pocket')
-                    self.watched = True
-                time.sleep(0.5)
-                continue
+            elif self.hero_pocket in [['__', '__'], ['  ', '  ']]:
+                idle = 'hero does not have a pocket'
 
             # do not analyze if hero is not to play
-            if self.hero != self.engine.q[0][0]:
-                if not self.watched:
-                    # logger.error('hero is not to act')
-                    self.watched = True
-                time.sleep(0.5)
-                continue
+            elif self.hero != self.engine.q[0][0]:
+                idle = 'hero is not to act'
+
+            elif self.POLICY == 'probable' and not self.frontier:
+                idle = 'mc is complete'
 
-            if self.is_complete:
-                if not self.watched:
-                    # logger.error('mc is complete')
-                    self.watched = True
-                time.sleep(2)
+            else:
+                # run a few sims
+                # logger.debug('running now with timeout {}'.format(self.WATCH_SLICE))
+                self.run(self.WATCH_SLICE)
                 continue
 
-            # run a few sims
-            # logger.debug('running now with timeout {}'.format(self.timeout))
-            self.run()
-            self.timeout += 0.1
+            if not self.watched:
+                logger.debug(f'waiting for the next engine state: {idle}')
+                self.watched = True
+            # only a new state can change any of the above
+            self.load_engine(self.hero)
 
     def run(self, duration):
         """Run simulations
@@ -154,34 +225,19 @@ class MonteCarlo:
         self.duration = duration
         self.time_start = time.time()
 
-        self.queue = PriorityQueue()
+        # one copy of the engine per run, rewound to the snapshot for every path
+        self.sim = deepcopy(self.engine)
+        self.sim.mc = True
+        self.sim_snapshot = self.sim.snapshot()
+
+        workers = self.start_workers(duration)
+
         # threads = []
         # for _ in range(self.N_THREADS):
         #     t = MCWorker(self)
         #     # t.start()
         #     threads.append(t)
 
-        # self.traversed_focus = 0
-        leaves = self.tree.paths_to_leaves()
-        # logger.debug('leaves from tree: {}'.format(len(leaves)))
-        # leaves.sort(key=lambda lp: len(lp) + sum(int(lpn.split('_')[0]) for lpn in lp), reverse=True)
-        # # logger.debug('{} leaves are now sorted by formula'.format(len(leaves)))
-        # logger.debug('{}'.format(json.dumps(leaves[:3], indent=4, default=str)))
-        # leaves.sort(key=len)
-        # logger.debug('{} leaves are now sorted by length'.format(len(leaves)))
-        # logger.debug('{}'.format(json.dumps(leaves[:3], indent=4, default=str)))
-        # leaves.sort(key=lambda lp: int(lp[-1][:3]), reverse=True)
-        # logger.debug('{} leaves are now sorted by rank'.format(len(leaves)))
-        # logger.error(json.dumps(leaves, indent=4, default=str))
-        # input('>>')
-        for leaf_path in leaves:
-            node = self.tree[leaf_path[-1]]
-            item = (
-                1 - node.data['cum_stats'],
-                leaf_path,
-            )
-            self.queue.put(item)
-
         # for t in threads:
         #     t.start()
         #
@@ -190,21 +246,79 @@ class MonteCarlo:
         #     if t.error:
         #         raise Exception().with_traceback(t.error[2])
 
-        while self.is_time_left() and not self.queue.empty():
-            priority, self.leaf_path = self.queue.get_nowait()
+        while self.POLICY == 'puct' and self.is_time_left():
+            if not self.run_puct():
+                break
+
+        while self.POLICY == 'probable' and self.is_time_left() and self.frontier:
+            priority, nid = heapq.heappop(self.frontier)
+            self.frontier_ids.discard(nid)
+            if self.tree.traversed[nid]:
+                # reached by an earlier path after it was queued
+                continue
+            if not self.owns(nid):
+                continue
+            self.leaf_path = self.tree.path(nid)
             self.run_item(self.leaf_path)
 
-        if self.queue.empty():
+        if self.POLICY == 'probable' and not self.frontier:
             logger.info(f'Everything was processed in queue!')
+        logger.info(f'Transpositions: {self.transpositions.info()}')
+        logger.info(f'Stats memo: {self.stats_memo.info()}')
+
+        self.merge_workers(workers, duration)
 
         total_traversions_end = sum(a[2] for a in self.current_actions)
         if total_traversions_end <= total_traversions_start:
             logger.warning(f'No new traversion added to {total_traversions_start}')
 
+    def start_workers(self, duration):
+        """Starts a search from the root in every other process (root parallelism). The search
+        is deterministic, so every process takes its own share of the root's children."""
+        if self.procs <= 1:
+            return []
+        pool = worker_pool(self.procs - 1)
+        return [pool.apply_async(run_root, (self.engine, self.hero, duration, (i, self.procs)))
+                for i in range(1, self.procs)]
+
+    def merge_workers(self, workers, duration):
+        """Keeps the root child stats of the workers' trees. Workers search a new tree every run,
+        so the largest search of an action is kept instead of adding up the repeats."""
+        for worker in workers:
+            try:
+                stats = worker.get(timeout=duration + 5)
+            except Exception as e:
+                logger.error(f'MC worker failed: {e}')
+                continue
+            for action, (ev, traversed) in stats.items():
+                if traversed > self.root_merged.get(action, (0, 0))[1]:
+                    self.root_merged[action] = (ev * traversed, traversed)
+        if workers:
+            logger.info(f'merged root stats of {len(workers)} workers: {self.root_merged}')
+
+    def owns(self, nid):
+        """Whether the node is under a root child of this process' share. Shares go by the
+        action name, which is the same in every process however the root children were added"""
+        index, parts = self.part
+        if parts <= 1 or self.tree.is_root(nid):
+            return True
+        path = self.tree.path(nid)
+        action = self.tree.action_name(path[1])
+        return int(hashlib.md5(action.encode()).hexdigest(), 16) % parts == index
+
     def run_item(self, path):
         # logger.debug('running this path: {}'.format(path))
-        e = deepcopy(self.engine)
-        e.mc = True
+        e = self.reset_sim()
+
+        # self.tree.show()
+        self.fast_forward(e, path)
+        # logger.info('{}'.format('-' * 200))
+        # input('check item')
+
+    def reset_sim(self):
+        """Rewinds the simulation engine to the root"""
+        e = self.sim
+        e.restore(self.sim_snapshot)
         """To calculate the investment for the loss EV, the total amounts used till end is required. Cannot
          use final player balance on engine as that might have winnings allocated to it by the engine. Instead
          the difference from all the new matched bets from the current matched bets will be used.
@@ -213,35 +327,76 @@ class MonteCarlo:
         e.matched_start = e.data[self.hero]['matched'] + e.data[self.hero]['contrib']
         # logger.info('hero starting with matched = {} from {} + {}'.format(
         #     e.matched_start, e.data[self.hero]['matched'], e.data[self.hero]['contrib']))
-
-        # self.tree.show()
-        self.fast_forward(e, path)
-        # logger.info('{}'.format('-' * 200))
-        # input('check item')
+        return e
+
+    def run_puct(self):
+        """One descent from the root to the end of the game, choosing hero actions by PUCT and
+        foe actions in proportion to their stats, then backs the EV up the path. False when none
+        of the root's children are this process' share."""
+        e = self.reset_sim()
+        tree = self.tree
+        nid = tree.root
+        path = [nid]
+        while True:
+            if not tree.is_root(nid) and tree.action_name(nid) == 'fold' and self.hero == tree.seat[nid]:
+                winnings, ev = self.net(e)
+                break
+            if tree.is_leaf(nid) and not tree.visits[nid]:
+                self.add_actions(e, nid)
+            else:
+                e.available_actions()
+            if tree.is_leaf(nid):
+                ev = self.leaf_ev(e)
+                break
+            nid = self.select_child(nid)
+            if nid is None:
+                return False
+            e.do(self.node_cmd(nid))
+            path.append(nid)
+
+        for n in path:
+            tree.visit(n, ev)
+            tree.ev[n] = tree.mean[n]
+            tree.traversed[n] = tree.visits[n]
+            self.widen(n)
+        return True
+
+    def select_child(self, nid):
+        """Hero maximises the PUCT score, foes are visited in proportion to their action stats.
+        Equal scores go to the hero action with the largest EV variance, its mean is the least
+        settled"""
+        tree = self.tree
+        children = tree.children(nid)
+        if tree.is_root(nid):
+            children = [c for c in children if self.owns(c)]
+            if not children:
+                return None
+        visits = tree.visits[nid]
+        if tree.seat[children[0]] != self.hero:
+            return max(children, key=lambda c: tree.stats[c] - tree.visits[c] / (visits + 1))
+        exploration = self.PUCT_C * self.engine.bb_amt * sqrt(visits + 1)
+        return max(children, key=lambda c: ((tree.mean[c] if tree.visits[c] else tree.mean[nid]) +
+                                            exploration * tree.stats[c] / (1 + tree.visits[c]),
+                                            tree.variance(c)))
 
     def show_best_action(self):
         """Calculates best action on root"""
         # logger.error("\n\n")
+        tree = self.tree
         sum_traversed = 0
         delta = 0
         max_ev = float('-inf')
         action = None
         amount = None
-        for nid in self.tree[self.tree.root].fpointer:
-            child = self.tree[nid]
-            # logger.debug('{} {}'.format(child.tag, child.data))
-            dat = child.data
-            sum_traversed += dat['traversed']
-            # logger.error('{} @{} => {}'.format(dat['action'], dat['traversed'], round(dat['ev'], 4)))
-
-            # delta += abs(1 - (self.convergence.get(dat['action'], 1) / dat['ev'] if dat['ev'] else 1))
-            # self.convergence[dat['action']] = dat['ev']
-
-            if dat['ev'] > max_ev:
-                max_ev = dat['ev']
-                action = dat['action']
+        for nid in tree.children(tree.root):
+            # logger.debug('{} {}'.format(tree.tag(nid), tree.ev[nid]))
+            sum_traversed += tree.traversed[nid]
+
+            if tree.ev[nid] > max_ev:
+                max_ev = tree.ev[nid]
+                action = tree.action_name(nid)
                 if action.startswith('bet') or action.startswith('raise') or action.startswith('allin'):
-                    amount = dat['amount']
+                    amount = tree.amount[nid]
 
         best_action = '{}{}'.format(action, ' with {}'.format(amount) if amount else '')
 
@@ -275,43 +430,41 @@ class MonteCarlo:
         """
         # logger.info('Fast forwarding {} nodes'.format(len(path)))
 
+        tree = self.tree
         if len(path) == 1:
             # logger.info('processing root for first time')
-            self.process_node(e, self.tree[path[0]])
+            self.process_node(e, path[0])
             return
 
-        leaf_node = self.tree[path[-1]]
         # logger.debug('checking if last node has been processed:')
-        # logger.debug('last node leaf {} has node data {}'.format(leaf_node.tag, leaf_node.data))
-        if leaf_node.data['traversed']:
+        if tree.traversed[path[-1]]:
             # logger.info('This leaf node ({}) above focus level {}'.format(leaf_node.tag, self.traversed_focus))
             # can happen as all actions are added, but then one was chosen to continue on
             # and that path for that action wasn't removed from the queue
             return
 
         for nid in path[1:]:
-            node = self.tree[nid]
-            # logger.debug('fast forwarding action for node {}'.format(node.tag))
+            # logger.debug('fast forwarding action for node {}'.format(tree.tag(nid)))
             e.available_actions()
-            cmd = [node.data['action'][0]]
-            if 'amount' in node.data:
-                cmd.append(node.data['amount'])
-                # logger.debug('Adding bet value of {}'.format(node.data['amount']))
-            # logger.debug('Executing path action {} for {}'.format(cmd, node.tag))
-            # logger.debug('Executing path action {} with data {}'.format(cmd, node.data))
-            e.do(cmd)
-
-            if node.is_leaf():
-                # logger.debug('{} is a leaf node, processing next...'.format(node.tag))
-                self.process_node(e, node)
+            e.do(self.node_cmd(nid))
+
+            if tree.is_leaf(nid):
+                # logger.debug('{} is a leaf node, processing next...'.format(tree.tag(nid)))
+                self.process_node(e, nid)
 
                 logger.info('nodes processed, now updating nodes that were fast forwarded')
                 for processed_nid in reversed(path[1:]):
-                    processed_node = self.tree[processed_nid]
-                    self.update_node(processed_node)
+                    self.update_node(processed_nid)
 
         self.ev_history[self.engine.s].append(sum(a[1] for a in self.current_actions))
 
+    def node_cmd(self, nid):
+        """Engine command for the node's action: the first letter, and the amount if any"""
+        cmd = [self.tree.action_name(nid)[0]]
+        if self.tree.has_amount(nid):
+            cmd.append(self.tree.amount[nid])
+        return cmd
+
     def process_node(self, e, n):
         """Process node
         Get actions available for node
@@ -319,69 +472,40 @@ class MonteCarlo:
         Process action selected
         Return EV
         """
-        # logger.info('processing node {} with data {}'.format(n.tag, n.data))
+        tree = self.tree
+        # logger.info('processing node {}'.format(tree.tag(n)))
 
         # this node is the hero folding (to prevent this being processed as leaf)
         # was created with other children (but not most probable at that time to be proc as child)
         # if hero folding, then make this node a leaf node with fold eq
         # exiting before adding children alleviates the need to remove the immediately again thereafter
         # bug: cannot use engine.q as it already rotated after taking action getting here
-        if not n.is_root() and n.data['action'] == 'fold' and self.hero == n.data['seat']:
+        if not tree.is_root(n) and tree.action_name(n) == 'fold' and self.hero == tree.seat[n]:
             winnings, losses = self.net(e)
-            result = {
-                'ev': losses,
-                'traversed': 1,
-            }
-            # logger.info('hero has folded this node given: {}'.format(result))
-            n.data.update(result)
-            # logger.info('node data after fold: {}'.format(n.data))
+            # logger.info('hero has folded this node given: {}'.format(losses))
+            tree.ev[n] = losses
+            tree.traversed[n] = 1
             return
 
         # add the children of the node
-        if not n.fpointer:
+        if tree.is_leaf(n):
             self.add_actions(e, n)
 
         # this node is a leaf (no more actions to take!)
         # either the game finished and we have winner and pot
         # or we have to use pokereval.winners
-        if n.is_leaf():
-            # logger.info('node {} is the final action in the game'.format(n.tag))
-            # winner given (easy resolution)
-            if e.winner:
-                # logger.debug('engine gave winner {}'.format(e.winner))
-                winnings, losses = self.net(e)
-                ev = winnings if self.hero in e.winner else losses
-            # else if the winner is unknown
-            # then calculate winners and use
-            # percentage of hero as amt
-            else:
-                if 'in' not in e.data[self.hero]['status']:
-                    # hero fold is handled before in method
-                    # and thus for equities calc it is just 0
-                    # logger.debug('Hero {} is not in game'.format(self.hero))
-                    ev = 0
-                else:
-                    winnings, losses = self.net(e)
-                    equities = PE.showdown_equities(e)
-                    # equities = self.get_showdown_equities(e)
-                    ev_pos = winnings * equities[self.hero]
-                    # logger.debug('ev_pos = {} from winnings {} * eq {}'.format(ev_pos, winnings, equities[self.hero]))
-                    ev_neg = losses * (1 - equities[self.hero])
-                    # logger.debug('ev_neg = {} from losses {} * -eq {}'.format(ev_neg, losses, (1 - equities[self.hero])))
-                    ev = ev_pos + ev_neg
-                    logger.info('Net EV: {} from {} + {}'.format(ev, ev_pos, ev_neg))
-            result = {
-                'ev': ev,
-                'traversed': 1,
-            }
-            # logger.info('{} leaf has result {}'.format(n.tag, result))
-            n.data.update(result)
+        if tree.is_leaf(n):
+            # logger.info('node {} is the final action in the game'.format(tree.tag(n)))
+            ev = self.leaf_ev(e)
+            # logger.info('{} leaf has ev {}'.format(tree.tag(n), ev))
+            tree.ev[n] = ev
+            tree.traversed[n] = 1
             return
 
         # node is all good (not leaf (has children) and not hero folding)
         # get child actions and process most probable action
         a_node = self.most_probable_action(n)
-        action = a_node.data['action']
+        action = tree.action_name(a_node)
         # logger.info('taking next child node action {}'.format(action))
 
         # if it is hero and he folds,
@@ -389,29 +513,58 @@ class MonteCarlo:
         # since my previous contrib needs to be added to the pot (i.e. contribs after starting mc)
         # i.e. make this a leaf node implicitly
         # no child nodes to remove for fold
-        if action == 'fold' and self.hero == a_node.data['seat']:
+        if action == 'fold' and self.hero == tree.seat[a_node]:
             winnings, losses = self.net(e)
-            result = {
-                'ev': losses,
-                'traversed': 1,
-            }
-            # logger.info('hero has folded the child node selected: {}'.format(result))
-            a_node.data.update(result)
-            # logger.info('a_node data after: {}'.format(a_node.data))
+            # logger.info('hero has folded the child node selected: {}'.format(losses))
+            tree.ev[a_node] = losses
+            tree.traversed[a_node] = 1
 
         # else we must process the node
         else:
             # logger.info('taking action {} and processing that node'.format(action))
-            cmd = [action[0]]
-            if 'amount' in a_node.data:
-                cmd.append(a_node.data['amount'])
-                # logger.debug('Adding bet value of {}'.format(a_node.data['amount']))
-            e.do(cmd)
+            e.do(self.node_cmd(a_node))
             self.process_node(e, a_node)
 
         # action node has been processed, now update node
         self.update_node(n)
 
+    def leaf_ev(self, e):
+        """Hero EV when no more actions can be taken, shared by transpositions. The EV depends
+        on the hero's starting investment, the known pockets and the players' strengths too."""
+        strengths = tuple(round(d['strength'], 3) for s, d in sorted(e.data.items()) if 'in' in d['status'])
+        hands = tuple(tuple(d['hand']) for s, d in sorted(e.data.items()))
+        key = ('ev', e.state_key(), e.matched_start, hands, strengths)
+        ev = self.transpositions.get(key)
+        if ev is None:
+            ev = self.eval_leaf(e)
+            self.transpositions.put(key, ev)
+        return ev
+
+    def eval_leaf(self, e):
+        # winner given (easy resolution)
+        if e.winner:
+            # logger.debug('engine gave winner {}'.format(e.winner))
+            winnings, losses = self.net(e)
+            return winnings if self.hero in e.winner else losses
+        # else if the winner is unknown
+        # then calculate winners and use
+        # percentage of hero as amt
+        if 'in' not in e.data[self.hero]['status']:
+            # hero fold is handled before in method
+            # and thus for equities calc it is just 0
+            # logger.debug('Hero {} is not in game'.format(self.hero))
+            return 0
+        winnings, losses = self.net(e)
+        equities = PE.showdown_equities(e)
+        # equities = self.get_showdown_equities(e)
+        ev_pos = winnings * equities[self.hero]
+        # logger.debug('ev_pos = {} from winnings {} * eq {}'.format(ev_pos, winnings, equities[self.hero]))
+        ev_neg = losses * (1 - equities[self.hero])
+        # logger.debug('ev_neg = {} from losses {} * -eq {}'.format(ev_neg, losses, (1 - equities[self.hero])))
+        ev = ev_pos + ev_neg
+        logger.info('Net EV: {} from {} + {}'.format(ev, ev_pos, ev_neg))
+        return ev
+
     def update_node(self, node):
         """Update the node's data
 
@@ -423,12 +576,16 @@ class MonteCarlo:
         Traversed will stay the traversed_focus level for leaves, but for parent nodes
         the traversed will be the number of leaves reached from that node.
         """
-        is_hero = node.data.get('seat') == self.hero
+        tree = self.tree
+        is_hero = tree.seat[node] == self.hero
         # logger.debug('is hero? {}'.format(is_hero))
 
+        # the root too can get more sizes
+        self.widen(node)
+
         # it will traverse back up to the root
         # root can be skipped
-        if node.is_root():
+        if tree.is_root(node):
             # input('hero {} node data {}'.format(self.hero, node.data.get('seat')))
             # if is_hero:
             #     self.rolling_10.append(abs(self.last_ev))
@@ -440,28 +597,18 @@ class MonteCarlo:
             return
 
         # fast forwarding will send here, just ignore node if leaf
-        if node.is_leaf():
-            # logger.debug('not updating {}: it is final game result (no leaf nodes)'.format(node.tag))
-            # logger.debug('not updating {}: final data {}'.format(node.tag, node.data))
+        if tree.is_leaf(node):
+            # logger.debug('not updating {}: it is final game result (no leaf nodes)'.format(tree.tag(node)))
             return
 
-        depth = self.tree.depth(node)
-        # logger.info('updating node {} at depth {}'.format(node.tag, depth))
-        # logger.info('node has {} before update'.format(node.data))
-
-        if not len(node.fpointer):
-            # logger.error('node {} with {} as no children...'.format(node.tag, node.data))
-            raise Exception('not necessary to process leaves')
-        # logger.debug('extracting data from {} children nodes...'.format(len(node.fpointer)))
+        # logger.info('updating node {}'.format(tree.tag(node)))
 
         n_ev = float('-inf') if is_hero else 0
         n_traversed = 0
-        for child_nid in node.fpointer:
-            child_node = self.tree[child_nid]
-            # logger.debug('child node {} has {}'.format(child_node.tag, child_node.data))
-            dat = child_node.data
-            if not dat['traversed']:
-                # logger.debug('skipping untraversed {}'.format(child_node.tag))
+        for child in tree.children(node):
+            # logger.debug('child node {} has ev {}'.format(tree.tag(child), tree.ev[child]))
+            if not tree.traversed[child]:
+                # logger.debug('skipping untraversed {}'.format(tree.tag(child)))
                 continue
 
             # get max for hero
@@ -469,27 +616,25 @@ class MonteCarlo:
                 # todo is this +ev dampening necessary
                 # todo this should be fixed when setting for hand range
                 # equities = PE.showdown_equities(self.engine)
-                # n_ev = max(n_ev, dat['ev'] * equities.get(self.hero, 0))
-                n_ev = max(n_ev, dat['ev'])
+                # n_ev = max(n_ev, tree.ev[child] * equities.get(self.hero, 0))
+                n_ev = max(n_ev, tree.ev[child])
 
             # get min for foe
             else:
-                # ev_adj = dat['ev'] * dat['stats']
+                # ev_adj = tree.ev[child] * tree.stats[child]
                 # logger.debug('foe min between {} and {}'.format(n_ev, ev_adj))
                 # n_ev = min(n_ev, ev_adj)
-                n_ev += dat['ev'] * dat['stats'] / dat['divider']
+                n_ev += tree.ev[child] * tree.stats[child] / tree.divider[child]
 
-            n_traversed += dat['traversed']
-            # logger.debug('added {} traversed: now have {} so far'.format(dat['traversed'], n_traversed))
+            n_traversed += tree.traversed[child]
+            # logger.debug('added {} traversed: now have {} so far'.format(tree.traversed[child], n_traversed))
 
-        self.last_ev = node.data['ev'] - n_ev
-        node.data.update({
-            'ev': n_ev,
-            'traversed': n_traversed,
-        })
-        # logger.info('now node has {} ev~{} after {}'.format(node.tag, round(n_ev, 3), n_traversed))
+        self.last_ev = tree.ev[node] - n_ev
+        tree.ev[node] = n_ev
+        tree.traversed[node] = n_traversed
+        # logger.info('now node has {} ev~{} after {}'.format(tree.tag(node), round(n_ev, 3), n_traversed))
 
-        if not node.data['traversed']:
+        if not tree.traversed[node]:
             raise Exception('node cannot be untraversed')
 
     def net(self, e):
@@ -516,15 +661,14 @@ class MonteCarlo:
         the most probable node for most accurate play. Using stats fields on data
         There should not be any untraversed nodes. So first get untraversed, then sort
         and pop first one"""
-        # logger.info('getting most probable action after {}'.format(parent.tag))
-        children = self.tree.children(parent.identifier)
-        children = [c for c in children if not c.data['traversed']]
+        tree = self.tree
+        # logger.info('getting most probable action after {}'.format(tree.tag(parent)))
+        children = [c for c in tree.children(parent) if not tree.traversed[c]]
         if not children:
             raise MonteCarloError('Cannot choose most probable action when all nodes are traversed')
-        children.sort(key=lambda c: c.data['stats'], reverse=True)
+        children.sort(key=lambda c: tree.stats[c], reverse=True)
         child = children[0]
-        # logger.debug('{} is untraversed, returning that node for actioning'.format(child.tag))
-        self.leaf_path.append(child.identifier)
+        # logger.debug('{} is untraversed, returning that node for actioning'.format(tree.tag(child)))
         return child
 
     def add_actions(self, e, parent):
@@ -542,7 +686,7 @@ class MonteCarlo:
 
         Scale non-fold probabilities even though it should not have an effect.
         """
-        # logger.info('adding actions to {}'.format(parent.tag))
+        # logger.info('adding actions to {}'.format(self.tree.tag(parent)))
         actions = e.available_actions()
         s, p = e.q[0]
         d = e.data[s]
@@ -579,7 +723,11 @@ class MonteCarlo:
         # logger.debug('removed allin by default')
 
         # load stats (codes with counts)
-        stats = ES.player_stats(e, s)
+        key = ES.stats_key(e, s)
+        stats = self.stats_memo.get(key)
+        if stats is None:
+            stats = ES.player_stats(e, s)
+            self.stats_memo.put(key, stats)
         max_contrib = max(pd['contrib'] for pd in e.data.values())
         # contrib_short = max_contrib - d['contrib']
 
@@ -604,20 +752,7 @@ class MonteCarlo:
             }
 
             if a in ['bet', 'raise']:
-                btps_and_amts = []
-                total_pot = sum(pd['contrib'] for pd in e.data.values()) + e.pot
-
-                # for preflop only do 2x and 3x
-                if e.phase == e.PHASE_PREFLOP:
-                    btps_and_amts.append(('double', e.bb_amt * 2))
-                    btps_and_amts.append(('triple', e.bb_amt * 3))
-                # else do half and full pots
-                else:
-                    btps_and_amts.append(('half_pot', total_pot * 0.50))
-                    btps_and_amts.append(('full_pot', total_pot * 1.00))
-                    # round bets up to a BB
-                    # btps_and_amts = [(btp, -(amt // -e.bb_amt) * e.bb_amt)
-                    #                  for btp, amt in btps_and_amts]
+                btps_and_amts = self.bet_sizes(e, stats)
 
                 betting_info = []
                 amts_seen = []
@@ -643,6 +778,11 @@ class MonteCarlo:
                     else:
                         betting_info_final.append((btp, amt))
 
+                # widening starts with the most likely size only
+                if self.WIDENING and betting_info_final:
+                    node_data['widening'] = betting_info_final[1:]
+                    betting_info_final = betting_info_final[:1]
+
                 # all good, can have this bet as option
                 for btp, amt in betting_info_final:
                     node_data_copy = deepcopy(node_data)
@@ -675,38 +815,129 @@ class MonteCarlo:
         # Also, certain actions like fold can be removed, and the total stats is not 1
         total_stats = sum(an['stats'] / an['divider'] for an in action_nodes)
         for action_node in action_nodes:
-            action_node['stats'] = max(0.01, action_node['stats'] / action_node['divider'] / total_stats)
-            action_node['cum_stats'] = parent.data['cum_stats'] * action_node['stats']
-            node_tag = f'{action_node["action"]}_{s}_{e.phase}'
-            identifier = f'{node_tag}_{str(uuid.uuid4())[:8]}'
-            self.tree.create_node(identifier=identifier, tag=node_tag, parent=parent.identifier, data=action_node)
-            # logger.debug('new {} for {} with data {}'.format(node_tag, s, action_node))
-            item = (
-                1 - action_node['cum_stats'],
-                self.leaf_path + [identifier]
-            )
-            self.queue.put(item)
+            stats = max(0.01, action_node['stats'] / action_node['divider'] / total_stats)
+            cum_stats = self.tree.cum_stats[parent] * stats
+            nid = self.tree.add(parent, action_node['action'], s, e.phase, stats, cum_stats,
+                                action_node['divider'], action_node.get('amount'))
+            # logger.debug('new {} for {} with data {}'.format(self.tree.tag(nid), s, action_node))
+            self.push_frontier(nid)
+            if action_node.get('widening'):
+                self.widening.setdefault(parent, {})[action_node['action'].split('_')[0]] = action_node['widening']
             # logger.debug('new {} for {} with data {}'.format(node_tag, s, action_node))
         # logger.info('{} node actions added'.format(len(action_nodes)))
 
+    def bet_sizes(self, e, stats):
+        """(label, amount) of the bet and raise sizes to search, most likely first"""
+        total_pot = sum(pd['contrib'] for pd in e.data.values()) + e.pot
+
+        # sizes players bet here before
+        if self.WIDENING and stats.get('btps'):
+            return [(f'pot{int(round(btp * 100))}', total_pot * btp) for btp in stats['btps']]
+
+        # for preflop only do 2x and 3x
+        if e.phase == e.PHASE_PREFLOP:
+            return [('double', e.bb_amt * 2), ('triple', e.bb_amt * 3)]
+
+        # else do half and full pots
+        # round bets up to a BB
+        # btps_and_amts = [(btp, -(amt // -e.bb_amt) * e.bb_amt)
+        #                  for btp, amt in btps_and_amts]
+        return [('half_pot', total_pot * 0.50), ('full_pot', total_pot * 1.00)]
+
+    def widen(self, nid):
+        """Adds the next bet and raise sizes of the node as far as its traversals allow"""
+        pending = self.widening.get(nid)
+        if not pending:
+            return
+        tree = self.tree
+        traversed = sum(tree.traversed[c] for c in tree.children(nid))
+        allowed = int(self.WIDEN_K * (traversed + 1) ** self.WIDEN_ALPHA)
+        for a, sizes in pending.items():
+            count = len(self.size_group(nid, a))
+            while sizes and count < allowed:
+                btp, amt = sizes.pop(0)
+                self.add_size(nid, a, f'{a}_{btp}', amt)
+                count += 1
+        if not any(pending.values()):
+            del self.widening[nid]
+
+    def size_group(self, parent, a):
+        """Children of the parent that are sizes of the bet or raise"""
+        tree = self.tree
+        return [c for c in tree.children(parent) if tree.action_name(c).startswith(f'{a}_')]
+
+    def add_size(self, parent, a, action, amount):
+        """Adds a size to the bet or raise of the parent, its sizes share the action's stats"""
+        tree = self.tree
+        group = self.size_group(parent, a)
+        group_stats = sum(tree.stats[c] for c in group)
+        stats = group_stats / (len(group) + 1)
+        for c in group:
+            tree.stats[c] = stats
+            tree.divider[c] = len(group) + 1
+            tree.cum_stats[c] = tree.cum_stats[parent] * stats
+        sibling = group[0]
+        nid = tree.add(parent, action, tree.seat[sibling], tree.PHASES[tree.phase[sibling]], stats,
+                       tree.cum_stats[parent] * stats, len(group) + 1, amount)
+        self.push_frontier(nid)
+        return nid
+
+    def observed_size(self, nid, amount):
+        """The node of the bet or raise taken, or a new size next to it when the amount is too
+        far off its size"""
+        tree = self.tree
+        if not tree.has_amount(nid) or abs(amount - tree.amount[nid]) <= self.OFF_SIZE * tree.amount[nid]:
+            return nid
+        a = tree.action_name(nid).split('_')[0]
+        if not self.size_group(tree.parent[nid], a):
+            return nid
+        logger.info(f'adding observed {a} of {amount} next to {tree.amount[nid]}')
+        return self.add_size(tree.parent[nid], a, f'{a}_observed', amount)
+
+    def reroot_action(self, action_name, action, seat, phase):
+        """Continues from the root child of the action the seat took (the closest size for bets
+        and raises). False when the tree has no such child, then it has to start again"""
+        tree = self.tree
+        child_nodes = tree.children(tree.root)
+        logger.debug(f'{len(child_nodes)} child nodes on tree {tree.root}')
+        action_nodes = [n for n in child_nodes if tree.action_name(n).startswith(action_name)]
+        if not action_nodes:
+            logger.warning(f'action {action_name} not found in nodes {[tree.action_name(n) for n in child_nodes]}')
+            return False
+        # direct
+        if len(action_nodes) == 1:
+            node = action_nodes[0]
+            logger.debug(f'Tree branched from single node {tree.tag(node)}')
+        # proximity
+        else:
+            nodes_diffs = {abs(tree.amount[n] - action[1]): n for n in action_nodes}
+            node = nodes_diffs[min(nodes_diffs.keys())]
+            logger.debug(f'tree recreated from closest node {tree.tag(node)} with {tree.amount[node]}')
+        # bet sizes not in the tree get their own node
+        if len(action) > 1:
+            node = self.observed_size(node, action[1])
+        self.reroot(node)
+        tag = tree.tag(tree.root)
+        if not tag.endswith('_{}_{}'.format(seat, phase)):
+            logger.error(f'Finished player {seat} in {phase} not in subtree tag {tag}')
+            return False
+        return True
+
     def analyze_tree(self):
         """Analyze tree to inspect best action from ev"""
         # self.tree.show()
 
         # check all finished paths
-        for path in self.tree.paths_to_leaves():
+        for leaf in self.tree.leaves():
 
             # skip untraversed end
-            last_node = self.tree[path[-1]]
-            if not last_node.data['traversed']:
-                logger.debug('skipping untraversed endpoint {}'.format(last_node.tag))
+            if not self.tree.traversed[leaf]:
+                logger.debug('skipping untraversed endpoint {}'.format(self.tree.tag(leaf)))
                 continue
 
             # show all actions
-            for nid in path:
-                node = self.tree[nid]
-                d = node.data
-                logger.info('Node: {} ev={}'.format(node.tag, d['ev']))
+            for nid in self.tree.path(leaf):
+                logger.info('Node: {} ev={}'.format(self.tree.tag(nid), self.tree.ev[nid]))
 
 
         0/0
@@ -728,6 +959,29 @@ class MonteCarlo:
         return equities
 
 
+@lru_cache(maxsize=None)
+def worker_pool(size):
+    """Worker processes, shared by the MC of every hand. They are spawned, not forked: the
+    parent already runs threads (the MC service, the game writer) and keep-alive sockets"""
+    settings = {cls: {k: v for k, v in vars(cls).items() if k.isupper()} for cls in [MonteCarlo, PE, ES]}
+    return multiprocessing.get_context('spawn').Pool(size, initializer=init_worker, initargs=(settings,))
+
+
+def init_worker(settings):
+    """A spawned worker imports the modules afresh: it takes the settings of the parent"""
+    for cls, values in settings.items():
+        for k, v in values.items():
+            setattr(cls, k, v)
+
+
+def run_root(engine, hero, duration, part):
+    """Searches a new tree for the part of the root's children in a worker process and returns
+    its root child stats"""
+    mc = MonteCarlo(engine=engine, hero=hero, procs=1, part=part)
+    mc.run(duration)
+    return mc.root_stats()
+
+
 class MonteCarloError(Exception):
     """Exception raised by MC"""
 
@@ -0,0 +1,125 @@
+from contextlib import contextmanager
+import logging
+from operator import itemgetter
+from threading import Thread, RLock, Event
+import time
+
+from engine.engine import EngineError
+
+
+logger = logging.getLogger(__name__)
+
+
+class MonteCarloService:
+    """Keeps the MC of the current hand searching in a background thread.
+
+    The search runs in short slices and the lock is only held for a slice, so a control call
+    (new hand, engine update, reroot) waits at most one slice. The root actions and EV history are
+    copied after every slice; readers get that snapshot without taking the lock.
+    """
+
+    # seconds searched per slice
+    SLICE = 0.1
+
+    def __init__(self):
+        self.lock = RLock()
+        self.mc = None
+        self.snapshot = []
+        self.history = {}
+        self.running = Event()
+        self.stopped = False
+        self.thread = None
+
+    def start(self, mc):
+        """Searches with the MC of a new hand"""
+        with self.lock:
+            self.mc = mc
+            self.snapshot = []
+            self.history = {}
+        self.running.set()
+        if self.thread is None:
+            self.thread = Thread(target=self.loop, name='mc-service', daemon=True)
+            self.thread.start()
+            logger.info('MC service started')
+
+    def pause(self):
+        """Stops searching after the current slice, until resumed or a new hand is started"""
+        self.running.clear()
+
+    def resume(self):
+        self.running.set()
+
+    def stop(self):
+        self.stopped = True
+        self.running.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def loop(self):
+        while not self.stopped:
+            self.running.wait()
+            if self.stopped:
+                break
+            with self.lock:
+                searched = self.search()
+            if not searched:
+                time.sleep(self.SLICE)
+
+    def search(self):
+        """Runs one slice if there is anything to search"""
+        mc = self.mc
+        if mc is None:
+            return False
+        e = mc.engine
+        if e.phase in [e.PHASE_SHOWDOWN, e.PHASE_GG] or 'in' not in e.data[mc.hero]['status']:
+            return False
+        if mc.POLICY == 'probable' and not mc.frontier:
+            return False
+        try:
+            mc.run(self.SLICE)
+        except EngineError as exc:
+            logger.error(exc)
+            mc.init_tree()
+        self.take_snapshot()
+        return True
+
+    def take_snapshot(self):
+        """Copies what readers get, under the lock"""
+        self.snapshot = self.mc.current_actions
+        self.history = {s: list(h) for s, h in self.mc.ev_history.items()}
+
+    @contextmanager
+    def paused(self):
+        """Holds the search while the engine or tree is changed, the snapshot is taken after"""
+        with self.lock:
+            yield self.mc
+            if self.mc is not None:
+                self.take_snapshot()
+
+    def update(self, engine):
+        """The engine changed outside of an action: start the tree again"""
+        with self.paused() as mc:
+            mc.engine = engine
+            mc.init_tree()
+
+    def reroot(self, action_name, action, seat, phase):
+        """The seat took the action: continue from its root child. False when the tree did not
+        have it (see MonteCarlo.reroot_action)"""
+        with self.paused() as mc:
+            return mc.reroot_action(action_name, action, seat, phase)
+
+    def actions(self):
+        """(action, ev, traversed) of the root children as of the last slice"""
+        return list(self.snapshot)
+
+    def best_action(self):
+        """(action, ev, traversed) with the highest EV as of the last slice, None before any"""
+        actions = self.actions()
+        if not actions:
+            return None
+        return max(actions, key=itemgetter(1))
+
+    def ev_history(self, seat):
+        """EV sums of the seat's root actions as of the last slice"""
+        return self.history.get(seat, [])
@@ -0,0 +1,152 @@
+from array import array
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+class ArrayTree:
+    """MC search tree kept in flat columns indexed by integer node id.
+
+    Children are a linked list (first_child, last_child, next_sibling) so adding a node is
+    an append to every column. The root is always node 0; reroot compacts the kept subtree
+    in place. Actions and phases are stored as codes, amounts are nan when the action has none.
+    """
+
+    ROOT = 0
+    NONE = -1
+    ACTIONS = []
+    ACTION_CODES = {}
+    PHASES = ['preflop', 'flop', 'turn', 'river', 'showdown', 'gg']
+
+    COLUMNS = {
+        'parent': 'l',
+        'first_child': 'l',
+        'last_child': 'l',
+        'next_sibling': 'l',
+        'ev': 'd',
+        'traversed': 'l',
+        'stats': 'd',
+        'cum_stats': 'd',
+        'divider': 'd',
+        'action': 'h',
+        'amount': 'd',
+        'seat': 'b',
+        'phase': 'b',
+        # running EV statistics of repeated visits (PUCT)
+        'visits': 'l',
+        'mean': 'd',
+        'm2': 'd',
+    }
+
+    def __init__(self):
+        for name, typecode in self.COLUMNS.items():
+            setattr(self, name, array(typecode))
+        self.add(self.NONE, 'root', seat=-1, phase=None, stats=1, cum_stats=1)
+
+    def __len__(self):
+        return len(self.parent)
+
+    @property
+    def root(self):
+        return self.ROOT
+
+    @classmethod
+    def action_code(cls, action):
+        code = cls.ACTION_CODES.get(action)
+        if code is None:
+            code = cls.ACTION_CODES[action] = len(cls.ACTIONS)
+            cls.ACTIONS.append(action)
+        return code
+
+    def add(self, parent, action, seat, phase, stats, cum_stats, divider=1, amount=None):
+        """Appends a child to the parent and returns its id"""
+        nid = len(self.parent)
+        self.parent.append(parent)
+        self.first_child.append(self.NONE)
+        self.last_child.append(self.NONE)
+        self.next_sibling.append(self.NONE)
+        self.ev.append(0)
+        self.traversed.append(0)
+        self.stats.append(stats)
+        self.cum_stats.append(cum_stats)
+        self.divider.append(divider)
+        self.action.append(self.action_code(action))
+        self.amount.append(float('nan') if amount is None else amount)
+        self.seat.append(seat)
+        self.phase.append(self.PHASES.index(phase) if phase else -1)
+        self.visits.append(0)
+        self.mean.append(0)
+        self.m2.append(0)
+        if parent != self.NONE:
+            if self.first_child[parent] == self.NONE:
+                self.first_child[parent] = nid
+            else:
+                self.next_sibling[self.last_child[parent]] = nid
+            self.last_child[parent] = nid
+        return nid
+
+    def visit(self, nid, ev):
+        """Adds the EV of a visit to the node's running mean and variance (Welford)"""
+        self.visits[nid] += 1
+        delta = ev - self.mean[nid]
+        self.mean[nid] += delta / self.visits[nid]
+        self.m2[nid] += delta * (ev - self.mean[nid])
+
+    def variance(self, nid):
+        return self.m2[nid] / (self.visits[nid] - 1) if self.visits[nid] > 1 else 0
+
+    def children(self, nid):
+        children = []
+        child = self.first_child[nid]
+        while child != self.NONE:
+            children.append(child)
+            child = self.next_sibling[child]
+        return children
+
+    def is_leaf(self, nid):
+        return self.first_child[nid] == self.NONE
+
+    def is_root(self, nid):
+        return nid == self.ROOT
+
+    def action_name(self, nid):
+        return self.ACTIONS[self.action[nid]]
+
+    def has_amount(self, nid):
+        return self.amount[nid] == self.amount[nid]
+
+    def tag(self, nid):
+        phase = self.PHASES[self.phase[nid]] if self.phase[nid] >= 0 else ''
+        return f'{self.action_name(nid)}_{self.seat[nid]}_{phase}'
+
+    def path(self, nid):
+        """Node ids from the root to the node"""
+        path = []
+        while nid != self.NONE:
+            path.append(nid)
+            nid = self.parent[nid]
+        return path[::-1]
+
+    def leaves(self):
+        return [nid for nid in range(len(self)) if self.first_child[nid] == self.NONE]
+
+    def reroot(self, nid):
+        """Keeps only the subtree of the node, which becomes the root. Ids are renumbered
+        breadth first so the columns stay compact; returns the old to new id mapping."""
+        order = [nid]
+        for n in order:
+            order.extend(self.children(n))
+        new_ids = {old: new for new, old in enumerate(order)}
+        remap = lambda n: new_ids.get(n, self.NONE)
+        for name, typecode in self.COLUMNS.items():
+            column = getattr(self, name)
+            values = [column[n] for n in order]
+            if name in ('parent', 'first_child', 'last_child', 'next_sibling'):
+                values = [remap(v) for v in values]
+            setattr(self, name, array(typecode, values))
+        # the new root has no parent or siblings
+        self.parent[self.ROOT] = self.NONE
+        self.next_sibling[self.ROOT] = self.NONE
+        logger.debug(f'tree rerooted on {nid} keeping {len(order)} nodes')
+        return new_ids
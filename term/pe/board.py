@@ -0,0 +1,162 @@
+from itertools import combinations
+import logging
+from threading import Thread, Lock
+import time
+
+import numpy as np
+
+from pe import evaluator
+
+
+logger = logging.getLogger(__name__)
+
+
+# the 1326 pockets as pairs of card indexes, and the pocket index of every pair of cards
+POCKETS = np.array(list(combinations(range(len(evaluator.CARDS)), 2)), dtype=np.int64)
+POCKET_INDEX = np.full((len(evaluator.CARDS), len(evaluator.CARDS)), -1, dtype=np.int64)
+POCKET_INDEX[POCKETS[:, 0], POCKETS[:, 1]] = np.arange(len(POCKETS))
+POCKET_INDEX[POCKETS[:, 1], POCKETS[:, 0]] = np.arange(len(POCKETS))
+
+
+def pocket_indexes(hand_range):
+    """Pocket index of every pocket (card strings) in the hand range"""
+    cards = np.array([[evaluator.to_index(c) for c in p] for p in hand_range], dtype=np.int64).reshape(-1, 2)
+    return POCKET_INDEX[cards[:, 0], cards[:, 1]]
+
+
+class BoardMatrix:
+    """Heads up equities of every pocket against every other pocket on a board.
+
+    Every runout of the board is dealt and all 1326 pockets are ranked on each of them (pockets
+    using a board card rank -1). The 1326x1326 matrix is then filled in chunks of rows, so only
+    about CHUNK_CELLS rank comparisons are held at once, and equities are a lookup. On the turn
+    and river the matrix is narrowed to the runouts with the new cards, so nothing is ranked again.
+    """
+
+    # runouts x pockets compared at once when filling the matrix
+    CHUNK_CELLS = 1 << 20
+
+    def __init__(self, board, runouts=None, ranks=None):
+        self.board = [c for c in board if c != evaluator.UNKNOWN]
+        if runouts is None:
+            known = [evaluator.to_index(c) for c in self.board]
+            deck = [c for c in range(len(evaluator.CARDS)) if c not in known]
+            runouts = np.array(list(combinations(deck, 5 - len(known))), dtype=np.int64).reshape(-1, 5 - len(known))
+            runouts = np.hstack([np.tile(known, (len(runouts), 1)), runouts])
+            ranks = self.rank_pockets(runouts)
+        self.runouts = runouts
+        self.ranks = ranks
+        self.matrix = self.fill(ranks)
+
+    @staticmethod
+    def rank_pockets(runouts):
+        """(runouts, pockets) ranks of every pocket on every runout, as the order of the hand
+        values on the runout (int16 keeps the comparisons small)"""
+        ranks = np.empty((len(runouts), len(POCKETS)), dtype=np.int16)
+        for i, runout in enumerate(runouts):
+            hands = np.hstack([np.tile(runout, (len(POCKETS), 1)), POCKETS])
+            values = evaluator.rank7(hands)
+            blocked = (POCKETS[:, :, None] == runout).any(axis=(1, 2))
+            values[blocked] = -1
+            distinct, order = np.unique(values, return_inverse=True)
+            ranks[i] = order - (distinct[0] < 0)
+        return ranks
+
+    @classmethod
+    def fill(cls, ranks):
+        """Equity of every pocket (row) against every pocket (column), nan for pockets sharing a
+        card. Each chunk of rows is compared with the columns from its first row on, the rest of
+        the matrix is mirrored."""
+        n = len(POCKETS)
+        matrix = np.full((n, n), np.nan, dtype=np.float32)
+        valid = ranks >= 0
+        rows = max(1, cls.CHUNK_CELLS // (len(ranks) * n))
+        for start in range(0, n, rows):
+            stop = min(n, start + rows)
+            ranks_a, ranks_b = ranks[:, start:stop, None], ranks[:, None, start:]
+            both = valid[:, start:stop, None] & valid[:, None, start:]
+            wins = ((ranks_a > ranks_b) & both).sum(axis=0)
+            ties = ((ranks_a == ranks_b) & both).sum(axis=0)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                equities = (wins + ties / 2) / both.sum(axis=0)
+            collide = (POCKETS[start:stop, None, :, None] == POCKETS[None, start:, None, :]).any(axis=(2, 3))
+            equities[collide] = np.nan
+            matrix[start:stop, start:] = equities
+            matrix[start:, start:stop] = 1 - equities.T
+        return matrix
+
+    def matches(self, board):
+        known = [c for c in board if c != evaluator.UNKNOWN]
+        return len(known) >= len(self.board) and known[:len(self.board)] == self.board
+
+    def narrowed(self, board):
+        """The matrix of the board with cards added, from the runouts that have them"""
+        known = [c for c in board if c != evaluator.UNKNOWN]
+        added = [evaluator.to_index(c) for c in known[len(self.board):]]
+        if not added:
+            return self
+        keep = np.all([(self.runouts == c).any(axis=1) for c in added], axis=0)
+        return BoardMatrix(known, self.runouts[keep], self.ranks[keep])
+
+    def equities(self, first, second):
+        """Equities of pockets first[k] against second[k] (pocket indexes). Pairs sharing a card
+        are nan."""
+        return self.matrix[first, second]
+
+
+class BoardMatrices:
+    """The board matrix of the current hand, built in the background when the flop is dealt and
+    narrowed in the background on the turn and river"""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.current = None
+        self.building = False
+        self.board = []
+
+    def prepare(self, board):
+        """Starts building the matrix for the board, unless a build is running (it picks the
+        board up when done)"""
+        known = [c for c in board if c != evaluator.UNKNOWN]
+        if len(known) < 3:
+            return
+        with self.lock:
+            self.board = known
+            if self.building or (self.current is not None and self.current.board == known):
+                return
+            self.building = True
+        Thread(target=self.build, name='board-matrix', daemon=True).start()
+
+    def build(self):
+        """Builds matrices till one for the latest board is ready"""
+        try:
+            while True:
+                with self.lock:
+                    board, current = self.board, self.current
+                if current is not None and current.board == board:
+                    return
+                time_start = time.time()
+                if current is not None and current.matches(board):
+                    matrix = current.narrowed(board)
+                else:
+                    matrix = BoardMatrix(board)
+                with self.lock:
+                    self.current = matrix
+                logger.info(f'board matrix for {board} built in {time.time() - time_start:.1f}s')
+        except Exception as e:
+            logger.exception(f'could not build the board matrix: {e}')
+        finally:
+            with self.lock:
+                self.building = False
+
+    def get(self, board):
+        """The matrix for the board if it is ready"""
+        known = [c for c in board if c != evaluator.UNKNOWN]
+        with self.lock:
+            matrix = self.current
+            if matrix is None or matrix.board != known:
+                return None
+            return matrix
+
+
+board_matrices = BoardMatrices()
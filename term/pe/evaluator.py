@@ -0,0 +1,208 @@
+from itertools import combinations
+import logging
+from math import factorial
+import random
+import time
+
+import numpy as np
+
+from pe.sampling import sample_adaptively
+
+
+logger = logging.getLogger(__name__)
+
+
+RANKS = '23456789tjqka'
+SUITS = 'sdch'
+CARDS = [f'{r}{s}' for r in RANKS for s in SUITS]
+CARD_INDEX = {c: i for i, c in enumerate(CARDS)}
+UNKNOWN = '__'
+# iterations between standard error checks when sampling adaptively
+CHUNK = 500
+
+# hand categories are stored above the (up to) 5 packed rank nibbles
+HIGH_CARD, PAIR, TWO_PAIR, TRIPS, STRAIGHT, FLUSH, FULL_HOUSE, QUADS, STRAIGHT_FLUSH = range(9)
+CATEGORY_SHIFT = 20
+
+
+def _build_tables():
+    """Lookup tables indexed by a 13 bit rank mask.
+
+    straights: rank of the highest straight in the mask (+1), 0 if none (wheel included)
+    tops: the top n ranks of the mask packed into nibbles, for n in 1, 2, 3, 5
+    """
+    size = 1 << len(RANKS)
+    straights = np.zeros(size, dtype=np.int64)
+    tops = {n: np.zeros(size, dtype=np.int64) for n in (1, 2, 3, 5)}
+    windows = [(0b11111 << low, low + 4) for low in range(8, -1, -1)]
+    windows.append((0b1000000001111, 3))
+    for mask in range(size):
+        for window, high in windows:
+            if mask & window == window:
+                straights[mask] = high + 1
+                break
+        ranks = [r for r in range(len(RANKS) - 1, -1, -1) if mask >> r & 1]
+        for n, table in tops.items():
+            table[mask] = pack(ranks[:n])
+    return straights, tops
+
+
+def pack(ranks):
+    """Pack ranks (high to low) into nibbles, most significant first"""
+    value = 0
+    for r in ranks:
+        value = value << 4 | r
+    return value
+
+
+STRAIGHTS, TOPS = _build_tables()
+
+
+def to_index(card):
+    return CARD_INDEX[card.lower()]
+
+
+def rank7(cards):
+    """Rank a batch of 7 card hands.
+
+    cards is an (n, 7) int array of card indexes (rank * 4 + suit). Returns an (n,) int array
+    where a higher value is the better hand; equal values are split pots.
+    """
+    cards = np.asarray(cards, dtype=np.int64)
+    ranks = cards >> 2
+    suits = cards & 3
+    rank_bits = np.left_shift(1, ranks)
+    rank_mask = np.bitwise_or.reduce(rank_bits, axis=1)
+
+    # rank groups sorted by (count, rank) descending
+    counts = (ranks[:, :, None] == np.arange(len(RANKS))).sum(axis=1)
+    groups = np.sort(np.where(counts, counts * 16 + np.arange(len(RANKS)), 0), axis=1)
+    c1, r1 = groups[:, -1] >> 4, groups[:, -1] & 15
+    c2, r2 = groups[:, -2] >> 4, groups[:, -2] & 15
+    without_r1 = rank_mask & ~np.left_shift(1, r1)
+    without_r12 = without_r1 & ~np.left_shift(1, r2)
+
+    # every category that applies is a candidate, the category bits make the best one the max
+    candidates = [
+        (c1 == 1, (HIGH_CARD << CATEGORY_SHIFT) | TOPS[5][rank_mask]),
+        (c1 == 2, (PAIR << CATEGORY_SHIFT) | (r1 << 12) | TOPS[3][without_r1]),
+        ((c1 == 2) & (c2 == 2), (TWO_PAIR << CATEGORY_SHIFT) | (r1 << 8) | (r2 << 4) | TOPS[1][without_r12]),
+        (c1 == 3, (TRIPS << CATEGORY_SHIFT) | (r1 << 8) | TOPS[2][without_r1]),
+        (STRAIGHTS[rank_mask] > 0, (STRAIGHT << CATEGORY_SHIFT) | (STRAIGHTS[rank_mask] - 1)),
+        ((c1 == 3) & (c2 >= 2), (FULL_HOUSE << CATEGORY_SHIFT) | (r1 << 4) | r2),
+        (c1 == 4, (QUADS << CATEGORY_SHIFT) | (r1 << 4) | TOPS[1][without_r1]),
+    ]
+    # at most one suit can hold 5 of 7 cards
+    for s in range(len(SUITS)):
+        is_suit = suits == s
+        flushing = is_suit.sum(axis=1) >= 5
+        if not flushing.any():
+            continue
+        suit_mask = np.bitwise_or.reduce(np.where(is_suit, rank_bits, 0), axis=1)
+        straight_flush = STRAIGHTS[suit_mask]
+        candidates.append((flushing, np.where(straight_flush > 0,
+                                              (STRAIGHT_FLUSH << CATEGORY_SHIFT) | (straight_flush - 1),
+                                              (FLUSH << CATEGORY_SHIFT) | TOPS[5][suit_mask])))
+
+    values = np.zeros(len(cards), dtype=np.int64)
+    for applies, candidate in candidates:
+        values = np.maximum(values, np.where(applies, candidate, 0))
+    return values
+
+
+def n_outcomes(deck_size, board_unknown, pockets_unknown):
+    """Number of distinct deals for the unknown board cards and unknown pockets"""
+    total = 1
+    left = deck_size
+    for k in [board_unknown] + [2] * pockets_unknown:
+        total *= factorial(left) // (factorial(k) * factorial(left - k))
+        left -= k
+    return total
+
+
+def _deals(deck, board_unknown, pockets_unknown):
+    """Enumerates every deal of the unknown cards: the board completion then each unknown pocket"""
+    for board in combinations(deck, board_unknown):
+        remaining = [c for c in deck if c not in board]
+        if not pockets_unknown:
+            yield board
+            continue
+        for rest in _deals(remaining, 2, pockets_unknown - 1):
+            yield board + rest
+
+
+def equities(board, pockets, iterations=20000, exact=False, stderr=None, budget=None):
+    """Equities for pockets on the board, in the same format as the poker-eval service.
+
+    Unknown cards are given as '__'. With exact every deal of the unknown cards is enumerated,
+    otherwise the given number of deals are sampled. With a target stderr and/or a time budget
+    (seconds) sampling is done in chunks and stops as soon as every pocket's equity is within
+    the stderr or the budget is spent; info[0] holds the iterations used.
+    """
+    if not exact and (stderr or budget):
+        return sample_adaptively(lambda chunk: equities(board, pockets, chunk), iterations, CHUNK, stderr, budget)
+    known = [to_index(c) for c in board if c != UNKNOWN]
+    board_unknown = 5 - len(known)
+    unknown_seats = []
+    hands = []
+    for i, pocket in enumerate(pockets):
+        if UNKNOWN in pocket:
+            unknown_seats.append(i)
+            hands.append([])
+        else:
+            hands.append([to_index(c) for c in pocket])
+            known.extend(hands[-1])
+    if len(set(known)) != len(known):
+        raise ValueError(f'duplicate cards in board {board} and pockets {pockets}')
+    deck = np.array([c for c in range(len(CARDS)) if c not in known], dtype=np.int64)
+    needed = board_unknown + 2 * len(unknown_seats)
+
+    if exact:
+        deals = list(_deals(list(deck), board_unknown, len(unknown_seats)))
+        deals = np.array(deals, dtype=np.int64).reshape(len(deals), needed)
+    else:
+        order = np.argsort(np.random.random((iterations, len(deck))), axis=1)[:, :needed]
+        deals = deck[order]
+    n = len(deals)
+
+    board_cards = np.empty((n, 5), dtype=np.int64)
+    board_cards[:, :5 - board_unknown] = known[:5 - board_unknown]
+    board_cards[:, 5 - board_unknown:] = deals[:, :board_unknown]
+    values = []
+    dealt = board_unknown
+    for i, hand in enumerate(hands):
+        if i in unknown_seats:
+            pocket_cards = deals[:, dealt:dealt + 2]
+            dealt += 2
+        else:
+            pocket_cards = np.tile(hand, (n, 1))
+        values.append(rank7(np.hstack([board_cards, pocket_cards])))
+    values = np.vstack(values)
+
+    best = values.max(axis=0)
+    winning = values == best
+    n_winners = winning.sum(axis=0)
+    evals = []
+    for seat_winning in winning:
+        wins = seat_winning & (n_winners == 1)
+        ties = seat_winning & (n_winners > 1)
+        share = np.where(seat_winning, 1 / n_winners, 0).sum()
+        evals.append({
+            'ev': int(1000 * share / n),
+            'scoop': int(wins.sum()),
+            'winhi': int(wins.sum()),
+            'losehi': int((~seat_winning).sum()),
+            'tiehi': int(ties.sum()),
+            'winlo': 0,
+            'loselo': 0,
+            'tielo': 0,
+        })
+    return {
+        'eval': evals,
+        'info': [n, 0, 1],
+    }
+
+
+def random_hands(n, size=7):
+    """Random hands of distinct cards for benchmarking"""
+    return np.array([random.sample(range(len(CARDS)), size) for _ in range(n)], dtype=np.int64)
@@ -1,12 +1,19 @@
-from collections import Counter
-from functools import lru_cache
-from itertools import product, chain
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
 import logging
 from math import ceil, floor
+import numpy as np
 import requests
-from sortedcontainers import SortedList
+from requests.adapters import HTTPAdapter
 import time
 
+from lru import LRUCache
+from pe import evaluator
+from pe.board import board_matrices, pocket_indexes
+from pe.preflop import PreflopTable
+from pe.store import equity_store
+
 
 logger = logging.getLogger(__name__)
 
@@ -14,6 +21,23 @@ logger = logging.getLogger(__name__)
 class PE:
     # Sample size for the product of the hand ranges
     SAMPLE_SIZE = 0.10
+    # Equities from the poker-eval 'service' or the in-process 'native' evaluator
+    EVALUATOR = 'service'
+    # Sampled deals per evaluation (the most sampled when adaptive)
+    ITERATIONS = 20000
+    # Stop sampling once every equity's standard error is below this (None samples all ITERATIONS)
+    STDERR = None
+    # Or once this many seconds were spent on an evaluation
+    BUDGET = None
+    # Enumerate every deal instead of sampling when there are no more deals than ITERATIONS
+    EXACT = True
+    SERVICE_URL = 'http://127.0.0.1:5657'
+    # Keep-alive connections to the service (and threads for the async client)
+    POOL_SIZE = 16
+    # Keep equities on disk for other processes and restarts
+    STORE = True
+    # Answer preflop spots from the precomputed table (when built)
+    PREFLOP_TABLE = True
 
     @classmethod
     def hand_strength(cls, hand, board=None, rivals=2):
@@ -24,7 +48,12 @@ class PE:
             pockets.append(['__'] * 2)
         if not board:
             board = ['__'] * 5
-        equities = req_equities(board, pockets)
+        if all(c == '__' for c in board):
+            table = preflop_table()
+            hand_strength = table and table.equity_vs_random(hand, rivals - 1)
+            if hand_strength is not None:
+                return hand_strength
+        equities = cached_equities(board, pockets)
         hand_strength = equities['eval'][0]['ev'] / 1000
         logger.debug(f'pocket {hand} strength: {hand_strength}, board {board}, rivals {rivals}')
         return hand_strength
@@ -84,7 +113,12 @@ class PE:
         pockets = [engine.data[s]['hand'] for s in seats]
         # logger.info('seats = {} and pockets = {} and board = {}'.format(seats, pockets, board))
 
-        eval_res = req_equities(board, pockets)
+        if not engine.board:
+            equities = cls.preflop_equities(seats, pockets)
+            if equities:
+                return equities
+
+        eval_res = cached_equities(board, pockets)
 
         equities = {}
         for s, e in zip(seats, eval_res['eval']):
@@ -94,63 +128,63 @@ class PE:
         logger.info('final equities: {}'.format(equities))
         return equities
 
+    @classmethod
+    def preflop_equities(cls, seats, pockets):
+        """Preflop equities from the table: one known pocket against random pockets, or two
+        known pockets heads up. None if the table cannot answer."""
+        table = preflop_table()
+        if not table:
+            return None
+        known = [i for i, p in enumerate(pockets) if '__' not in p]
+        if len(known) == 1:
+            hero = known[0]
+            equity = table.equity_vs_random(pockets[hero], len(pockets) - 1)
+            if equity is None:
+                return None
+            share = (1 - equity) / (len(pockets) - 1)
+            return {s: equity if i == hero else share for i, s in enumerate(seats)}
+        if len(known) == 2 == len(pockets):
+            equity = table.equity_vs_pocket(pockets[0], pockets[1])
+            if equity is None:
+                return None
+            return {seats[0]: equity, seats[1]: 1 - equity}
+        return None
+
     @classmethod
     def showdown_equities_2(cls, engine, seats, hand_ranges, seats_len):
         time_start = time.time()
         board = engine.board + ['__'] * (5 - len(engine.board))
-        board_len = len(Counter(board))
 
-        calcs = 0
+        # two known pockets preflop are in the table
+        if not engine.board and all(len(hr) == 1 for hr in hand_ranges):
+            equities = cls.preflop_equities(seats, [list(hr[0]) for hr in hand_ranges])
+            if equities:
+                return equities
+
         logger.debug('calculating equities for {} players with {}'.format(seats_len, board))
         logger.debug('calculating equities for {} hands'.format(len(hand_ranges)))
-        equities_evals = {s: [] for s in seats}
-        for hrp in product(*hand_ranges):
-            # logger.debug('HRP = {} {}'.format(len(hrp), hrp))
-            cnts = Counter([c for h in list(hrp) + board for c in h])
-            if len(cnts) < seats_len * 2 + board_len:
-                # logger.debug('duplicated cards found {} < {} * 2 + {} [{}]'.format(
-                #     len(cnts), seats_len, board_len, cnts.most_common()))
-                continue
-            calcs += 1
-            hrps = list(chain.from_iterable(map(list, hrp)))
-            # logger.debug('hrps {} and board {}'.format(hrps, board))
-            eval = pokereval_2(*board, *hrps)
-            for s, e, p in zip(seats, eval['eval'], hrp):
-                # logger.debug('s={} e={} p={}'.format(s, e, p))
-                equities_evals[s].append(e['ev'] / 1000)
-
-        # have now a list of equities for every player
-        # every player has same length of evals
-        # sort the equities in order to map it to hand strengths
-        # logger.debug('sorting equities evals...')
-        equities_ranked = {s: {} for s in seats}
-        for s, equity_eval in equities_evals.items():
-            equity_ranked = SortedList(equity_eval)
-            equities_ranked[s] = equity_ranked
-            # logger.debug('sorted list = {}'.format(equity_ranked))
-
-        # the equities are now averaged per pocket
-        # get hand probs to map against
-
-        hss = {s: (0, 1) if len(hr) == 1 else (1 - engine.data[s]['strength'], 1)
-                      for s, hr in zip(seats, hand_ranges)}
-        # logger.debug('hand strength boundaries {}'.format(hss))
-
-        # now have list of sorted avg equities and hand strength boundaries
-        # average card equities within range
-        # todo: maybe recalc?
-
-        # logger.debug('cutting hand ranges')
-        equities_filtered = {s: [] for s in seats}
-        for s in seats:
-            per = equities_ranked[s]
-            hs = hss[s]
-            start = floor(len(per) * hs[0])
-            end = ceil(len(per) * hs[1]) + 1
-            # logger.debug('seat {} range start at {} and end at {}'.format(s, start, end))
-            rng_fil = per[start:end]
-            # logger.debug('seat {} has {} filtered equities'.format(s, len(rng_fil)))
-            equities_filtered[s] = 0 if not rng_fil else sum(rng_fil) / len(rng_fil)
+        ranges = [encode_range(hr) for hr in hand_ranges]
+        combos = range_product(ranges, board)
+        calcs = len(combos[0])
+        if not calcs:
+            raise RuntimeError(f'no hand range combination without duplicate cards on {board}')
+
+        # rows are combinations, columns are seats
+        matrix = board_matrices.get(board) if seats_len == 2 else None
+        if matrix is not None:
+            first, second = (pocket_indexes(hr)[idx] for hr, idx in zip(hand_ranges, combos))
+            equities_first = matrix.equities(first, second)
+            equities_evals = np.column_stack([equities_first, 1 - equities_first])
+        else:
+            # all surviving combinations go to the evaluator together
+            hrps = [tuple(hr[i] for hr, i in zip(hand_ranges, idx)) for idx in zip(*combos)]
+            evals = cached_equities_batch([(board, hrp) for hrp in hrps])
+            equities_evals = np.array([[e['ev'] for e in eval['eval']] for eval in evals]) / 1000
+
+        # a known pocket averages everything, a range only the top of its sorted equities
+        hss = [(0, 1) if len(hr) == 1 else (1 - engine.data[s]['strength'], 1)
+               for s, hr in zip(seats, hand_ranges)]
+        equities_filtered = dict(zip(seats, percentile_means(equities_evals, hss)))
 
         # final normalization to return p~1
         total_equities = sum(e for e in equities_filtered.values())
@@ -159,29 +193,260 @@ class PE:
 
         # duration = time.time() - time_start
         # logger.info('calculated {}/s  [{} calcs in {}s]'.format(calcs // duration, calcs, duration))
-        # logger.info('cache info: {}'.format(pokereval_2.cache_info()))
 
         # logger.info('final equities: {}'.format(equities))
         return equities
 
 
-@lru_cache(maxsize=1 << 18)
-def pokereval_2(b1, b2, b3, b4, b5, c1, c2, c3, c4):
-    board = [b1, b2, b3, b5, b5]
-    hrp = [[c1, c2], [c3, c4]]
-    # logger.debug('reconstructed b= {} & c= {}'.format(board, hrp))
-    equities = req_equities(board, hrp)
-    # logger.debug('{} => {}'.format(hrp, [e['ev'] for e in eval['eval']]))
+def encode_range(hand_range):
+    """Hand range as an (n, 2) int array of card indexes"""
+    return np.array([[evaluator.to_index(c) for c in pocket] for pocket in hand_range], dtype=np.int64).reshape(-1, 2)
+
+
+def range_product(ranges, board):
+    """Indexes into every encoded range for the combinations of the ranges product that do not
+    share cards with each other or the board. Returns one index array per range."""
+    board_mask = np.uint64(sum(1 << evaluator.to_index(c) for c in board if c != evaluator.UNKNOWN))
+    one = np.uint64(1)
+    masks = [np.left_shift(one, r[:, 0].astype(np.uint64)) | np.left_shift(one, r[:, 1].astype(np.uint64))
+             for r in ranges]
+    grids = np.meshgrid(*[np.arange(len(m)) for m in masks], indexing='ij')
+    idxs = [g.ravel() for g in grids]
+
+    combined = np.full(len(idxs[0]), board_mask, dtype=np.uint64)
+    valid = np.ones(len(idxs[0]), dtype=bool)
+    for m, idx in zip(masks, idxs):
+        seat_masks = m[idx]
+        valid &= (combined & seat_masks) == 0
+        combined |= seat_masks
+    return [idx[valid] for idx in idxs]
+
+
+def percentile_means(equities, cuts):
+    """Mean equity per column within its (start, end) fraction of the sorted column"""
+    ranked = np.sort(equities, axis=0)
+    means = []
+    for column, (low, high) in zip(ranked.T, cuts):
+        start = floor(len(column) * low)
+        end = ceil(len(column) * high) + 1
+        rng_fil = column[start:end]
+        means.append(0 if not len(rng_fil) else float(rng_fil.mean()))
+    return means
+
+
+@lru_cache(maxsize=1)
+def preflop_table():
+    """The preflop table, loaded once. None if disabled or not built yet."""
+    if not PE.PREFLOP_TABLE:
+        return None
+    return PreflopTable.load()
+
+
+def canonical(board, pockets):
+    """Suit isomorphic key for the board and pockets.
+
+    Board order and the order within a pocket do not matter, and neither do the suit names:
+    AsKs on 2h3h4d is the same spot as AhKh on 2s3s4d. The seat order is kept as the equities
+    are returned per seat. Unknown cards are -1.
+
+    Suits are relabelled in the order of their signature: the ranks they have on the board and
+    in every pocket. Suits with the same signature hold the same ranks everywhere, so how their
+    tie is broken does not change the key."""
+    board = [-1 if c == evaluator.UNKNOWN else evaluator.to_index(c) for c in board]
+    pockets = [[-1 if c == evaluator.UNKNOWN else evaluator.to_index(c) for c in p] for p in pockets]
+    signatures = [
+        (tuple(sorted(c >> 2 for c in board if c >= 0 and c & 3 == suit)),
+         tuple(tuple(sorted(c >> 2 for c in p if c >= 0 and c & 3 == suit)) for p in pockets))
+        for suit in range(len(evaluator.SUITS))
+    ]
+    order = sorted(range(len(signatures)), key=signatures.__getitem__)
+    relabel = {suit: i for i, suit in enumerate(order)}
+    return (
+        tuple(sorted(c if c < 0 else c & ~3 | relabel[c & 3] for c in board)),
+        tuple(tuple(sorted(c if c < 0 else c & ~3 | relabel[c & 3] for c in p)) for p in pockets),
+    )
+
+
+# shared by hand strengths and the showdown equities
+equities_cache = LRUCache(1 << 18)
+# combinations per batch request to the service
+BATCH_SIZE = 512
+
+
+def equities_key(board, pockets):
+    """Cache key of the canonical spot, the evaluator and the precision it is evaluated with
+    (0 iterations when exact)"""
+    if is_exact(board, pockets):
+        return canonical(board, pockets) + (PE.EVALUATOR, 0, None, None)
+    return canonical(board, pockets) + (PE.EVALUATOR, PE.ITERATIONS, PE.STDERR, PE.BUDGET)
+
+
+def cached_equities(board, pockets):
+    """Equities for the board and pockets, requested only if no isomorphic spot is cached
+    in memory or in the store"""
+    key = equities_key(board, pockets)
+    equities = equities_cache.get(key)
+    if equities is None and PE.STORE:
+        equities = equity_store.get(key)
+        if equities is not None:
+            equities_cache.put(key, equities)
+    if equities is None:
+        equities = req_equities(board, pockets)
+        equities_cache.put(key, equities)
+        if PE.STORE:
+            equity_store.put(key, equities)
+    return equities
+
+
+def cached_equities_batch(jobs):
+    """Equities for many (board, pockets) jobs. Jobs not cached yet are requested in batches."""
+    keys = [equities_key(board, pockets) for board, pockets in jobs]
+    results = {}
+    missing = {}
+    for key, job in zip(keys, jobs):
+        if key in results or key in missing:
+            continue
+        equities = equities_cache.get(key)
+        if equities is None:
+            missing[key] = job
+        else:
+            results[key] = equities
+    if missing and PE.STORE:
+        for key, equities in equity_store.get_many(missing).items():
+            results[key] = equities
+            equities_cache.put(key, equities)
+            del missing[key]
+    missing = list(missing.items())
+    for i in range(0, len(missing), BATCH_SIZE):
+        chunk = missing[i:i + BATCH_SIZE]
+        evals = req_equities_batch([(list(board), [list(p) for p in pockets]) for _, (board, pockets) in chunk])
+        for (key, _), equities in zip(chunk, evals):
+            results[key] = equities
+            equities_cache.put(key, equities)
+            if PE.STORE:
+                equity_store.put(key, equities)
+    logger.debug(f'batch of {len(keys)} jobs requested {len(missing)} equities')
+    return [results[k] for k in keys]
+
+
+def is_exact(board, pockets):
+    """Whether enumerating every deal of the unknown cards is cheaper than sampling, e.g. on the
+    river or on the turn with known pockets"""
+    if not PE.EXACT:
+        return False
+    known = [c for c in list(board) + [c for p in pockets for c in p] if c != evaluator.UNKNOWN]
+    board_unknown = list(board).count(evaluator.UNKNOWN)
+    pockets_unknown = sum(evaluator.UNKNOWN in p for p in pockets)
+    deals = evaluator.n_outcomes(len(evaluator.CARDS) - len(known), board_unknown, pockets_unknown)
+    return deals <= PE.ITERATIONS
+
+
+def precision(board, pockets):
+    """Sampling parameters for the evaluators"""
+    if is_exact(board, pockets):
+        return {'exact': True}
+    params = {'iterations': PE.ITERATIONS}
+    if PE.STDERR:
+        params['stderr'] = PE.STDERR
+    if PE.BUDGET:
+        params['budget'] = PE.BUDGET
+    return params
+
+
+@lru_cache(maxsize=1)
+def session():
+    """Keep-alive session to the service, shared by threads"""
+    s = requests.Session()
+    s.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=PE.POOL_SIZE))
+    return s
+
+
+@lru_cache(maxsize=1)
+def executor():
+    return ThreadPoolExecutor(PE.POOL_SIZE)
+
+
+async def req_equities_async(board, pockets):
+    """req_equities for asyncio callers: the request runs on the pooled session in a thread"""
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(executor(), partial(req_equities, board, pockets))
+
+
+async def req_equities_batch_async(jobs):
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(executor(), partial(req_equities_batch, jobs))
+
+
+def req_equities_batch(jobs):
+    """Makes one request to service for PE for a list of (board, pockets) jobs"""
+    if not jobs:
+        return []
+    if PE.EVALUATOR == 'native':
+        return [evaluator.equities(board, pockets, **precision(board, pockets)) for board, pockets in jobs]
+    logger.debug('requesting equities for {} jobs'.format(len(jobs)))
+    res = session().post(f'{PE.SERVICE_URL}/batch', json={
+        'jobs': [dict(board=board, pockets=pockets, **precision(board, pockets)) for board, pockets in jobs],
+    })
+    res.raise_for_status()
+    equities = res.json()['results']
     return equities
 
 
 def req_equities(board, pockets):
-    """Makes request to service for PE"""
+    """Makes request to service for PE, or evaluates in-process with the native evaluator"""
+    if PE.EVALUATOR == 'native':
+        return evaluator.equities(board, pockets, **precision(board, pockets))
     logger.debug('requesting equities for board {} and pockets {}'.format(board, pockets))
-    res = requests.post('http://127.0.0.1:5657/', json={
-        'pockets': pockets,
-        'board': board,
-    })
+    res = session().post(f'{PE.SERVICE_URL}/', json=dict(
+        pockets=pockets,
+        board=board,
+        **precision(board, pockets)
+    ))
     res.raise_for_status()
     equities = res.json()
+    logger.debug(f'equities sampled with {equities["info"][0]} iterations')
     return equities
+
+
+def benchmark(duration=5):
+    """Evaluations per second of the native ranker, and equity requests per second of
+    both evaluators for the same spots"""
+    results = {}
+
+    hands = evaluator.random_hands(100000)
+    time_start = time.time()
+    ranked = 0
+    while time.time() - time_start < duration:
+        evaluator.rank7(hands)
+        ranked += len(hands)
+    results['native_ranks_per_s'] = ranked / (time.time() - time_start)
+    logger.info(f'native ranker: {results["native_ranks_per_s"]:.0f} hands/s')
+
+    spots = [
+        (['__'] * 5, [['as', 'ac'], ['__'] * 2]),
+        (['2h', '7d', 'tc', '__', '__'], [['as', 'ac'], ['kd', 'kh']]),
+        (['2h', '7d', 'tc', 'js', '__'], [['as', 'ac'], ['kd', 'kh'], ['__'] * 2]),
+    ]
+    for name in ['native', 'service']:
+        evaluator_prev = PE.EVALUATOR
+        PE.EVALUATOR = name
+        try:
+            requests_done = 0
+            evaluations = 0
+            time_start = time.time()
+            while time.time() - time_start < duration:
+                board, pockets = spots[requests_done % len(spots)]
+                equities = req_equities(board, pockets)
+                requests_done += 1
+                evaluations += equities['info'][0] * len(pockets)
+        except requests.ConnectionError as e:
+            logger.warning(f'{name} evaluator not available: {e}')
+            continue
+        finally:
+            PE.EVALUATOR = evaluator_prev
+        elapsed = time.time() - time_start
+        results[f'{name}_requests_per_s'] = requests_done / elapsed
+        results[f'{name}_evals_per_s'] = evaluations / elapsed
+        logger.info(f'{name} evaluator: {requests_done / elapsed:.1f} requests/s, {evaluations / elapsed:.0f} evals/s')
+
+    return results
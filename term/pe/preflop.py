@@ -0,0 +1,117 @@
+from itertools import combinations
+import logging
+from os.path import dirname, realpath, join, exists
+
+import numpy as np
+
+from pe import evaluator
+
+
+logger = logging.getLogger(__name__)
+
+
+class PreflopTable:
+    """Preflop equities of the 169 starting hand classes.
+
+    vs_random[c, n - 1] is the equity of class c against n random pockets, and vs_class[c, o] the
+    heads up equity of class c against class o (averaged over the suits of o). Two known pockets
+    are looked up by their suit isomorphic pair instead, since suits interact: AsKs against QsJs
+    is not AsKs against QhJh. pair_keys are sorted with pair_equities the equity of the first
+    pocket. Stored as float32 in a flat binary file, the keys as the bits of int32.
+
+    Class index is hi * 13 + lo for suited hands, lo * 13 + hi for offsuit and r * 13 + r for pairs,
+    with ranks indexed as in the evaluator.
+    """
+
+    FILE = join(dirname(realpath(__file__)), 'preflop.bin')
+    CLASSES = 169
+    MAX_OPPONENTS = 9
+
+    def __init__(self, vs_random, vs_class, pair_keys, pair_equities):
+        self.vs_random = vs_random
+        self.vs_class = vs_class
+        self.pair_keys = pair_keys
+        self.pair_equities = pair_equities
+
+    @classmethod
+    def load(cls, path=FILE):
+        if not exists(path):
+            logger.warning(f'no preflop table at {path}: run `main.py preflop` to build it')
+            return None
+        values = np.fromfile(path, dtype=np.float32)
+        size_random = cls.CLASSES * cls.MAX_OPPONENTS
+        size = size_random + cls.CLASSES ** 2
+        if len(values) < size or (len(values) - size) % 2:
+            logger.error(f'preflop table {path} has unexpected size {len(values)}')
+            return None
+        pairs = (len(values) - size) // 2
+        if not pairs:
+            logger.warning(f'preflop table {path} has no pocket pairs: run `main.py preflop` to rebuild it')
+        logger.info(f'preflop table loaded from {path}')
+        return cls(
+            values[:size_random].reshape(cls.CLASSES, cls.MAX_OPPONENTS),
+            values[size_random:size].reshape(cls.CLASSES, cls.CLASSES),
+            values[size:size + pairs].view(np.int32),
+            values[size + pairs:],
+        )
+
+    def save(self, path=FILE):
+        order = np.argsort(self.pair_keys)
+        np.concatenate([
+            self.vs_random.ravel().astype(np.float32),
+            self.vs_class.ravel().astype(np.float32),
+            np.asarray(self.pair_keys, dtype=np.int32)[order].view(np.float32),
+            np.asarray(self.pair_equities, dtype=np.float32)[order],
+        ]).tofile(path)
+        logger.info(f'preflop table saved to {path}')
+
+    @staticmethod
+    def hand_class(pocket):
+        hi, lo = sorted((evaluator.to_index(c) for c in pocket), reverse=True)
+        r_hi, r_lo = hi >> 2, lo >> 2
+        if (hi & 3) == (lo & 3):
+            return r_hi * 13 + r_lo
+        return r_lo * 13 + r_hi
+
+    @staticmethod
+    def class_pockets(hand_class):
+        """Every pocket (as card strings) of the class"""
+        row, col = divmod(hand_class, 13)
+        suits = evaluator.SUITS
+        if row == col:
+            return [(f'{evaluator.RANKS[row]}{s1}', f'{evaluator.RANKS[row]}{s2}')
+                    for s1, s2 in combinations(suits, 2)]
+        if row > col:
+            return [(f'{evaluator.RANKS[row]}{s}', f'{evaluator.RANKS[col]}{s}') for s in suits]
+        return [(f'{evaluator.RANKS[col]}{s1}', f'{evaluator.RANKS[row]}{s2}')
+                for s1 in suits for s2 in suits if s1 != s2]
+
+    def equity_vs_random(self, pocket, opponents):
+        if not 1 <= opponents <= self.MAX_OPPONENTS:
+            return None
+        return float(self.vs_random[self.hand_class(pocket), opponents - 1])
+
+    @staticmethod
+    def pair_key(pocket, other):
+        """Suit isomorphic key of the two pockets heads up (in order), as one int. Suits are
+        relabelled in the order of the ranks they have in each pocket, as in pe.canonical"""
+        pockets = [[evaluator.to_index(c) for c in p] for p in (pocket, other)]
+        signatures = [tuple(tuple(sorted(c >> 2 for c in p if c & 3 == suit)) for p in pockets)
+                      for suit in range(len(evaluator.SUITS))]
+        order = sorted(range(len(signatures)), key=signatures.__getitem__)
+        relabel = {suit: i for i, suit in enumerate(order)}
+        key = 0
+        for p in pockets:
+            for c in sorted(c & ~3 | relabel[c & 3] for c in p):
+                key = key * 52 + c
+        return key
+
+    def equity_vs_pocket(self, pocket, other):
+        """Heads up equity of the pocket against the other, None when the pair is not in the
+        table. Only one order of a pair may be stored"""
+        for key, flip in [(self.pair_key(pocket, other), False), (self.pair_key(other, pocket), True)]:
+            i = int(np.searchsorted(self.pair_keys, key))
+            if i < len(self.pair_keys) and self.pair_keys[i] == key:
+                equity = float(self.pair_equities[i])
+                return 1 - equity if flip else equity
+        return None
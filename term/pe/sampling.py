@@ -0,0 +1,50 @@
+"""Adaptive sampling of equities, shared by the native evaluator and the poker-eval service.
+
+Only the standard library is used: the service mounts this file next to app_sanic.py.
+"""
+from math import sqrt
+import time
+
+
+def combine(equities, done, res, chunk):
+    """Adds the chunk's counts to the equities, ev is weighted by iterations"""
+    if equities is None:
+        return res
+    for total, e in zip(equities['eval'], res['eval']):
+        for k, v in e.items():
+            if k == 'ev':
+                total[k] = (total[k] * done + v * chunk) / (done + chunk)
+            else:
+                total[k] += v
+    return equities
+
+
+def max_stderr(equities, done):
+    """Largest standard error of the pockets' pot shares (ties counted as half shares)"""
+    errors = []
+    for e in equities['eval']:
+        mean = e['ev'] / 1000
+        second_moment = (e['scoop'] + 0.25 * e['tiehi']) / done
+        errors.append(sqrt(max(0, second_moment - mean ** 2) / done))
+    return max(errors)
+
+
+def sample_adaptively(evaluate, iterations, chunk_size, stderr=None, budget=None):
+    """Calls evaluate(chunk) for chunks of sampled deals until every pocket's equity is within the
+    stderr, the budget (seconds) is spent or all iterations are done. The iterations used are
+    returned in info[0]."""
+    time_start = time.time()
+    equities = None
+    done = 0
+    while done < iterations:
+        chunk = min(chunk_size, iterations - done)
+        equities = combine(equities, done, evaluate(chunk), chunk)
+        done += chunk
+        if stderr and max_stderr(equities, done) <= stderr:
+            break
+        if budget and time.time() - time_start >= budget:
+            break
+    for e in equities['eval']:
+        e['ev'] = int(round(e['ev']))
+    equities['info'][0] = done
+    return equities
@@ -0,0 +1,102 @@
+import atexit
+import json
+import logging
+import os
+from os.path import dirname, realpath, join
+from queue import Queue, Empty
+import sqlite3
+from threading import Thread, local
+
+
+logger = logging.getLogger(__name__)
+
+
+class EquityStore:
+    """Persistent equities by key, shared between processes and restarts.
+
+    SQLite in WAL mode lets the scraper and the MC watcher read concurrently while either writes.
+    Writes are queued and committed in batches by a background thread, so the caller never waits
+    on the disk.
+    """
+
+    FILE = join(dirname(realpath(__file__)), 'equities.db')
+    BATCH_SIZE = 256
+
+    def __init__(self, path=FILE):
+        self.path = path
+        self.queue = Queue()
+        self.local = local()
+        self.writer = None
+        self.writer_pid = None
+
+    def connection(self):
+        """Connection for the current thread (sqlite connections cannot be shared)"""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or self.local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS equities (key TEXT PRIMARY KEY, equities TEXT NOT NULL)')
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
+
+    @staticmethod
+    def encode(key):
+        return json.dumps(key, separators=(',', ':'))
+
+    def get(self, key):
+        row = self.connection().execute(
+            'SELECT equities FROM equities WHERE key = ?', (self.encode(key),)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def get_many(self, keys):
+        """Stored equities for the keys that are found"""
+        found = {}
+        keys = list(keys)
+        encoded = {self.encode(k): k for k in keys}
+        conn = self.connection()
+        # stay below the sqlite host parameters limit
+        names = list(encoded)
+        for i in range(0, len(names), 500):
+            chunk = names[i:i + 500]
+            rows = conn.execute('SELECT key, equities FROM equities WHERE key IN ({})'.format(
+                ','.join('?' * len(chunk))), chunk)
+            for name, equities in rows:
+                found[encoded[name]] = json.loads(equities)
+        return found
+
+    def put(self, key, equities):
+        """Queues the equities to be written"""
+        if self.writer_pid != os.getpid():
+            self.writer = Thread(target=self.write_loop, name='equity-store', daemon=True)
+            self.writer.start()
+            self.writer_pid = os.getpid()
+        self.queue.put((self.encode(key), json.dumps(equities)))
+
+    def write_loop(self):
+        conn = self.connection()
+        while True:
+            rows = [self.queue.get()]
+            try:
+                while len(rows) < self.BATCH_SIZE:
+                    rows.append(self.queue.get_nowait())
+            except Empty:
+                pass
+            try:
+                with conn:
+                    conn.executemany('INSERT OR REPLACE INTO equities (key, equities) VALUES (?, ?)', rows)
+            except sqlite3.Error as e:
+                logger.error(f'could not store {len(rows)} equities: {e}')
+            finally:
+                for _ in rows:
+                    self.queue.task_done()
+
+    def flush(self):
+        """Waits for queued equities to be written"""
+        if self.writer_pid == os.getpid():
+            self.queue.join()
+
+
+equity_store = EquityStore()
+atexit.register(equity_store.flush)
@@ -5,8 +5,10 @@ from os.path import dirname, realpath, join
 from random import random
 import shelve
 from sortedcontainers import SortedDict
+import numpy as np
 
-from pe.pe import PE
+from pe.pe import PE, cached_equities_batch, preflop_table
+from pe.preflop import PreflopTable
 
 
 logger = logging.getLogger()
@@ -22,6 +24,12 @@ class PocketRankings:
         pocket_rankings = PocketRankings()
         pocket_rankings.create_rankings()
 
+    @classmethod
+    def run_preflop(cls):
+        logger.info('running preflop table...')
+        pocket_rankings = PocketRankings()
+        pocket_rankings.create_preflop_table()
+
     @classmethod
     def load(cls):
         """Loads from file and return in sorted dictionary"""
@@ -55,3 +63,49 @@ class PocketRankings:
         with shelve.open(self.FILE) as shlv:
             shlv['pocket_rankings'] = pocket_rankings
             logger.info('saved to {}'.format(self.FILE))
+
+    def create_preflop_table(self):
+        """Equities of every starting hand class against 1 to 9 random pockets and heads up
+        against every other class, saved as a binary table for PE."""
+        classes = PreflopTable.CLASSES
+        board = ['__'] * 5
+
+        # the pockets of a class are suit isomorphic, so one pocket represents it
+        pockets = [PreflopTable.class_pockets(c)[0] for c in range(classes)]
+
+        vs_random = np.zeros((classes, PreflopTable.MAX_OPPONENTS), dtype=np.float32)
+        for n in range(1, PreflopTable.MAX_OPPONENTS + 1):
+            jobs = [(board, [list(p)] + [['__'] * 2] * n) for p in pockets]
+            for c, equities in enumerate(cached_equities_batch(jobs)):
+                vs_random[c, n - 1] = equities['eval'][0]['ev'] / 1000
+            logger.info(f'{classes} classes done against {n} random pockets')
+
+        # heads up against every pocket of the same or a later class that does not share cards.
+        # With the class pocket fixed these are all the suit isomorphic pairs of the two classes,
+        # kept per pair, and averaged per class
+        vs_class = np.full((classes, classes), 0.5, dtype=np.float32)
+        pairs = {}
+        for c in range(classes):
+            jobs = []
+            others = []
+            for o in range(c, classes):
+                for pocket in PreflopTable.class_pockets(o):
+                    if set(pocket) & set(pockets[c]):
+                        continue
+                    jobs.append((board, [list(pockets[c]), list(pocket)]))
+                    others.append(o)
+            totals = np.zeros(classes)
+            counts = np.zeros(classes)
+            for (_, pair), o, equities in zip(jobs, others, cached_equities_batch(jobs)):
+                equity = equities['eval'][0]['ev'] / 1000
+                pairs[PreflopTable.pair_key(*pair)] = equity
+                if o > c:
+                    totals[o] += equity
+                    counts[o] += 1
+            done = counts > 0
+            vs_class[c, done] = totals[done] / counts[done]
+            vs_class[done, c] = 1 - vs_class[c, done]
+            logger.info(f'class {c + 1}/{classes} done heads up')
+
+        PreflopTable(vs_random, vs_class, list(pairs), list(pairs.values())).save()
+        preflop_table.cache_clear()
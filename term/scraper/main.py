@@ -1,4 +1,5 @@
 from collections import Counter
+from contextlib import contextmanager
 import datetime
 from itertools import combinations
 import json
@@ -11,9 +12,11 @@ from retrace import retry
 import time
 
 from engine.engine import Engine, EngineError
-from es.es import ES
+from es.es import ES, game_writer
 from mc.mc import MonteCarlo
-from pe.pe import PE
+from mc.service import MonteCarloService
+from pe.board import board_matrices
+from pe.pe import PE, equities_cache
 from scraper.sites.base import SiteException, NoDealerButtonError, PocketError, ThinkingPlayerError, BalancesError, \
     BoardError, PlayerActionError, GamePhaseError, BalanceNotFound
 from scraper.sites.coinpoker.site import CoinPoker
@@ -44,8 +47,13 @@ class Scraper(View):
         'a': 'allin',
     }
 
-    def __init__(self, site_name, seats, debug=False, replay=False, observe=False):
+    def __init__(self, site_name, seats, debug=False, replay=False, observe=False, procs=1, anytime=False):
         self.debug = debug
+        self.procs = procs
+        logger.debug('MC processes {}'.format(self.procs))
+        # keep searching in the background instead of between scrapes
+        self.mc_service = MonteCarloService() if anytime else None
+        logger.debug('MC anytime {}'.format(anytime))
         logger.debug('Debug {}'.format(self.debug))
         self.observe = observe
         logger.debug('Observing {}'.format(self.observe))
@@ -196,8 +204,11 @@ class Scraper(View):
 
         if len(board) > len(self.engine.board):
             logger.debug(f'The board changed with {set(board) - set(self.engine.board)}')
-            self.engine.board = board
+            with self.mc_paused():
+                self.engine.board = board
             self.board_moved = True
+            # pocket vs pocket equities for the showdowns on this board
+            board_matrices.prepare(board)
 
         logger.debug('board: {}'.format(self.engine.board))
 
@@ -249,6 +260,12 @@ class Scraper(View):
         have varied too much from the current board by making the closes action"""
         logger.info('Running MC analysis')
 
+        # already searching in the background
+        if self.mc_service:
+            logger.info(f'best action so far: {self.mc_service.best_action()}')
+            self.print()
+            return
+
         # if self.debug:
         #     timeout = 0.4
 
@@ -267,7 +284,7 @@ class Scraper(View):
                 # if self.debug:
                 #     profiler.stop()
                 logger.error(e)
-                self.mc.init_tree()
+                self.mc_update()
                 self.mc.run(timeout)
             # duration = time.time() - time_start
             # if not self.mc.queue.empty() and duration > timeout * 2:
@@ -403,6 +420,15 @@ class Scraper(View):
                                             self.engine.current_pot, self.board_moved, self.expected,
                                             expect_text)
 
+        # the background search waits till the engine and tree caught up
+        with self.mc_paused():
+            self.do_player_action(s, phase, cmd)
+
+        logger.debug('get next actions')
+        self.expected = self.engine.available_actions()
+
+    def do_player_action(self, s, phase, cmd):
+        """Does the action on the engine and cuts the tree to it"""
         # do action, rotate, and get next actions
         logger.debug(f'parsed action {cmd}')
         action = self.engine.do(cmd)
@@ -412,38 +438,13 @@ class Scraper(View):
         # cut tree based on action
         # do not have to cut tree when button moved
         if not self.button_moved:
-            # self.mc.analyze_tree()
-            child_nodes = self.mc.tree.children(self.mc.tree.root)
-            logger.debug(f'{len(child_nodes)} child nodes on tree {self.mc.tree.root}')
-            # logger.info('nodes:\n{}'.format(json.dumps([n.tag for n in child_nodes], indent=4, default=str)))
-            action_nodes = [n for n in child_nodes if n.data['action'].startswith(action_name)]
-            # create new
-            if not action_nodes:
-                logger.warning(f'action {action_name} not found in nodes {[n.data["action"] for n in child_nodes]}')
-                self.mc.init_tree()
-                logger.debug('tree recreated')
-            # subtree
+            if self.mc_service:
+                rerooted = self.mc_service.reroot(action_name, action, s, phase)
             else:
-                # direct
-                if len(action_nodes) == 1:
-                    node = action_nodes[0]
-                    self.mc.tree = self.mc.tree.subtree(node.identifier)
-                    logger.debug(f'Tree branched from single node {node.tag}')
-                    logger.debug(f'tree branched from single node {node.data}')
-                # proximity
-                else:
-                    nodes_diffs = {abs(n.data['amount'] - action[1]): n for n in action_nodes}
-                    node = nodes_diffs[min(nodes_diffs.keys())]
-                    self.mc.tree = self.mc.tree.subtree(node.identifier)
-                    logger.debug(f'tree recreated from closest node {node.tag}')
-                    logger.debug(f'tree recreated from closest node {node.data}')
-                    # increment traversed level
-                if not node.tag.endswith('_{}_{}'.format(s, phase)):
-                    logger.error(f'Finished player {s} in {phase} not in subtree tag {node.tag}')
-                    self.mc.init_tree()
-
-        logger.debug('get next actions')
-        self.expected = self.engine.available_actions()
+                rerooted = self.mc.reroot_action(action_name, action, s, phase)
+            if not rerooted:
+                self.mc_update()
+                logger.debug('tree recreated')
 
     def check_players_pockets(self, filter_seat=None):
         """Check if player has back side of pocket, otherwise check what his cards are"""
@@ -472,7 +473,8 @@ class Scraper(View):
                 logger.info(f'Player {s} is showing {pocket}')
                 pockets[s] = pocket
                 if hasattr(self, 'engine'):
-                    self.engine.data[s]['hand'] = pocket
+                    with self.mc_paused():
+                        self.engine.data[s]['hand'] = pocket
                 continue
 
             logger.info(f'Player {s} has no cards')
@@ -486,14 +488,16 @@ class Scraper(View):
         """Get name hashes and set it to players"""
         name = self.site.parse_names(self.img, seat)
         if name:
-            self.players[seat]['name'] = name
+            with self.mc_paused():
+                self.players[seat]['name'] = name
             logger.info(f'Player {seat} name is {name}')
 
     def check_player_balance(self, seat):
         """Update player balances"""
         balance = self.site.parse_balances(self.img, seat)
         if balance:
-            self.players[seat]['balance'] = balance
+            with self.mc_paused():
+                self.players[seat]['balance'] = balance
             logger.debug(f'Player {seat} balance is {balance}')
 
     def start_new_game(self):
@@ -565,9 +569,11 @@ class Scraper(View):
         logger.debug(f'seat {self.engine.q[0][0]} available actions: {self.expected}')
 
         logger.debug('creating MC...')
-        self.mc = MonteCarlo(engine=self.engine, hero=self.site.HERO)
+        self.mc = MonteCarlo(engine=self.engine, hero=self.site.HERO, procs=self.procs)
 
         self.post_start(pockets)
+        if self.mc_service:
+            self.mc_service.start(self.mc)
 
         logger.info('new game created!')
         self.waiting_for_new_game = False
@@ -621,8 +627,10 @@ class Scraper(View):
         The status of players can be set if they have any balance/contrib"""
         for s in range(1, self.site.seats + 1):
             status = s in vs_players
-            self.players[s]['status'] = status
-            self.players[s]['sitout'] = False
+            # the players are shared with the engine searched in the background
+            with self.mc_paused():
+                self.players[s]['status'] = status
+                self.players[s]['sitout'] = False
             if not status:
                 continue
 
@@ -655,7 +663,8 @@ class Scraper(View):
         hero = self.site.HERO
         pocket = pockets.get(hero)
         if pocket:
-            self.engine.data[hero]['hand'] = pocket
+            with self.mc_paused():
+                self.engine.data[hero]['hand'] = pocket
             logger.info(f'Hero (p{hero}) hand set to {pocket}')
         else:
             logger.error('No hero pocket found!')
@@ -673,6 +682,8 @@ class Scraper(View):
         #     return self.check_showdown_winner()
 
         self.waiting_for_new_game = True
+        if self.mc_service:
+            self.mc_service.pause()
         self.save_game()
         logger.info(f'Game over! Player {self.engine.winner} won!')
         if self.debug:
@@ -707,9 +718,26 @@ class Scraper(View):
         winner = max(contribs.items(), key=itemgetter(1))[0]
         logger.info(f'Winner of showdown is {winner}')
         cmd = ['gg', winner]
-        self.engine.do(cmd)
+        with self.mc_paused():
+            self.engine.do(cmd)
         self.finish_it()
 
+    @contextmanager
+    def mc_paused(self):
+        """Holds the background search while the engine or tree is changed"""
+        if self.mc_service:
+            with self.mc_service.paused():
+                yield
+        else:
+            yield
+
+    def mc_update(self):
+        """Starts the search tree again on the current engine"""
+        if self.mc_service:
+            self.mc_service.update(self.engine)
+        else:
+            self.mc.init_tree()
+
     def cards(self):
         """Generate cards for a site"""
         self.site.generate_cards()
@@ -729,3 +757,6 @@ class Scraper(View):
                 if balance_txt == 'sit out':
                     d['sitout'] = True
         ES.save_game(self.players, self.engine.data, self.engine.site_name, self.engine.vs, self.engine.board)
+        logger.info(f'Equities cache: {equities_cache.info()}')
+        logger.info(f'Game writer: {game_writer.info()}')
+        logger.info(f'Query cache: {ES.cache_info()}')
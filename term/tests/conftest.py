@@ -0,0 +1,6 @@
+import os
+
+
+# player stats come from the local store (es/local.py), so the tests need no Elasticsearch node.
+# STATS_BACKEND=es runs them against Elasticsearch
+os.environ.setdefault('STATS_BACKEND', 'local')
@@ -0,0 +1,78 @@
+from threading import Event
+
+from es.writer import GameWriter
+
+
+class TestGameWriter:
+
+    def test_batches_and_flush(self):
+        written = []
+        writing, release = Event(), Event()
+
+        def write(docs):
+            writing.set()
+            release.wait(5)
+            written.append(docs)
+
+        writer = GameWriter(write)
+        writer.put(lambda: [{'player': 'joe'}])
+        writing.wait(5)
+        # the jobs queued while the first batch is written go together in the next one
+        for i in range(3):
+            writer.put(lambda i=i: [{'player': 'jane', 'i': i}, {'player': 'joe', 'i': i}])
+        release.set()
+        writer.flush()
+
+        assert [len(docs) for docs in written] == [1, 6]
+        info = writer.info()
+        assert info['jobs'] == 4
+        assert info['batches'] == 2
+        assert info['docs'] == 7
+        assert info['depth'] == 0
+
+    def test_errors_are_counted(self):
+        def write(docs):
+            raise ValueError('down')
+
+        writer = GameWriter(write)
+        writer.RETRY_WAIT = 0
+        writer.put(lambda: [{'player': 'joe'}])
+        writer.flush()
+        info = writer.info()
+        assert info['errors'] == writer.RETRIES + 1
+        assert info['retries'] == writer.RETRIES
+        assert info['dropped'] == 1
+        assert info['docs'] == 0
+
+    def test_failed_job_and_docs(self):
+        written = []
+
+        def job():
+            raise ValueError('bad game')
+
+        def write(docs):
+            # the first write of a doc fails
+            failed = [doc for doc in docs if doc not in written]
+            written.extend(docs)
+            return [doc for doc in failed if doc['player'] == 'jane']
+
+        writer = GameWriter(write)
+        writer.RETRY_WAIT = 0
+        # the docs of the other games are written when one game fails to build
+        writer.put(job)
+        writer.put(lambda: [{'player': 'joe'}, {'player': 'jane'}])
+        writer.flush()
+        assert written == [{'player': 'joe'}, {'player': 'jane'}, {'player': 'jane'}]
+        info = writer.info()
+        assert info['errors'] == 1
+        assert info['retries'] == 1
+        assert info['docs'] == 2
+        assert info['dropped'] == 0
+
+    def test_flush_timeout(self):
+        release = Event()
+        writer = GameWriter(lambda docs: release.wait(5) and [])
+        writer.put(lambda: [{'player': 'joe'}])
+        assert not writer.flush(0.05)
+        release.set()
+        assert writer.flush(5)
@@ -0,0 +1,123 @@
+import datetime
+
+from es.local import LocalStore
+
+
+def function_score(should, functions=(), must_not=()):
+    return {
+        'function_score': {
+            'query': {'bool': {'should': list(should), 'must_not': list(must_not)}},
+            'functions': list(functions),
+            'score_mode': 'sum',
+            'boost_mode': 'sum',
+        }
+    }
+
+
+class TestLocalStore:
+
+    def store(self, tmpdir):
+        store = LocalStore(str(tmpdir.join('game_actions.db')))
+        now = datetime.datetime.utcnow()
+        docs = [
+            ('joe', 'f', None, 2, 0.2),
+            ('joe', 'r', 0.5, 2, 0.7),
+            ('joe', 'r', 1.0, 6, 0.9),
+            ('jane', 'c', None, 2, 0.4),
+            ('jane', 'l', None, 2, 0.3),
+        ]
+        for i, (player, action, btp, vs, hs) in enumerate(docs):
+            doc = {'player': player, 'site': 'CoinPoker', 'vs': vs, 'preflop_1': action, 'preflop_1_hs': hs,
+                   'preflop_aggro': action == 'r', 'created_at': now - datetime.timedelta(minutes=i)}
+            if btp:
+                doc['preflop_1_btp'] = btp
+            store.save(doc)
+        return store
+
+    def test_sample_aggs(self, tmpdir):
+        store = self.store(tmpdir)
+        query = function_score([
+            {'match': {'player': {'query': 'joe', 'boost': 1}}},
+            {'match': {'site': {'query': 'CoinPoker', 'boost': 0.5}}},
+        ], must_not=[{'term': {'preflop_1': 'l'}}])
+        terms, percentiles = store.sample_aggs(query, 10, terms_field='preflop_1', percentiles_field='preflop_1_btp',
+                                               percents=[50])
+        # limps are excluded, docs without btp are left out of the percentiles
+        assert terms == {'r': 2, 'f': 1, 'c': 1}
+        assert percentiles == {50: 0.75}
+
+        # only the best scoring docs are sampled
+        terms, _ = store.sample_aggs(query, 3, terms_field='preflop_1')
+        assert terms == {'r': 2, 'f': 1}
+
+    def test_decay_functions(self, tmpdir):
+        store = self.store(tmpdir)
+        query = function_score(
+            [{'match': {'site': {'query': 'CoinPoker', 'boost': 0.5}}}],
+            [{'gauss': {'vs': {'origin': 6, 'scale': 1, 'decay': 0.2}}}],
+        )
+        docs = store.sample_aggs(query, 10, docs_size=5)
+        assert docs[0]['vs'] == 6
+        assert docs[0]['_score'] == 1.5
+        # gauss at one scale away scores the decay
+        assert abs(docs[1]['_score'] - 0.5) < 1e-9
+
+        # missing fields score 1
+        query = function_score(
+            [{'match': {'preflop_aggro': {'query': True, 'boost': 4}}}],
+            [{'linear': {'preflop_1_btp': {'origin': 0.5, 'scale': 0.5, 'decay': 0.5}}}],
+        )
+        docs = store.sample_aggs(query, 10, docs_size=5)
+        assert [d['preflop_1_btp'] for d in docs] == [0.5, 1.0]
+        assert [d['_score'] for d in docs] == [5, 4.5]
+
+    def test_unstored_fields(self, tmpdir):
+        store = self.store(tmpdir)
+        # third actions are not stored: they match nothing and decay to 1
+        query = function_score([
+            {'match': {'site': {'query': 'CoinPoker', 'boost': 0.5}}},
+            {'match': {'preflop_3': {'query': 'c', 'boost': 10}}},
+            {'exists': {'field': 'preflop_3_hs'}},
+        ], [{'gauss': {'preflop_3_po': {'origin': 0.3, 'scale': 0.05, 'decay': 0.1}}}])
+        docs = store.sample_aggs(query, 10, docs_size=5)
+        assert [d['_score'] for d in docs] == [1.5] * 5
+        terms, percentiles = store.sample_aggs(query, 10, terms_field='preflop_3', percentiles_field='preflop_3_btp',
+                                               percents=[50])
+        assert terms == {}
+        assert percentiles == {50: None}
+
+    def test_delete_player(self, tmpdir):
+        store = self.store(tmpdir)
+        assert store.player_counts() == [('joe', 3), ('jane', 2)]
+        assert store.delete_player('joe') == 3
+        query = function_score([{'exists': {'field': 'preflop_1_hs'}}])
+        _, percentiles = store.sample_aggs(query, 10, percentiles_field='preflop_1_hs', percents=[50])
+        assert abs(percentiles[50] - 0.35) < 1e-9
+
+    def test_sample_aggs_many(self, tmpdir):
+        store = self.store(tmpdir)
+        requests = [
+            {'function_score': function_score([
+                {'match': {'player': {'query': player, 'boost': 1}}},
+                {'match': {'site': {'query': 'CoinPoker', 'boost': 0.5}}},
+            ], [{'linear': {'vs': {'origin': 2, 'scale': 1, 'decay': 0.2}}}]),
+             'sample_size': 2, 'terms_field': 'preflop_1', 'percentiles_field': 'preflop_1_hs', 'percents': [50]}
+            for player in ['joe', 'jane']
+        ]
+        # grouped as one query, the shared clauses are scored once
+        assert store.sample_aggs_many(requests) == [store.sample_aggs(**r) for r in requests]
+        assert store.sample_aggs_many(requests)[1] == ({'c': 1, 'l': 1}, {50: 0.35})
+
+        # a doc saved during the batch is left to the next one, all requests score the same docs
+        expected = store.sample_aggs_many(requests)
+        sample_aggs = store.sample_aggs
+
+        def save_and_sample_aggs(**request):
+            store.save({'player': 'jane', 'site': 'CoinPoker', 'vs': 2, 'preflop_1': 'r', 'preflop_1_hs': 0.9,
+                        'created_at': datetime.datetime.utcnow()})
+            return sample_aggs(**request)
+
+        store.sample_aggs = save_and_sample_aggs
+        assert store.sample_aggs_many(requests) == expected
+        del store.sample_aggs
+        assert store.sample_aggs_many(requests)[1] == ({'r': 2}, {50: 0.9})
@@ -1,6 +1,7 @@
 from operator import itemgetter
 
 from mc.mc import MonteCarlo
+from mc.tree import ArrayTree
 from engine.engine import Engine
 
 
@@ -25,7 +26,7 @@ class TestMonteCarlo:
             mc.run(1)
             total_traversions.append(sum(a[2] for a in mc.current_actions))
             # assert len(mc.current_actions) > 0
-        traversed_leaves = list(mc.tree.filter_nodes(lambda n: n.is_leaf() and n.data['traversed'] > 0))
+        traversed_leaves = [n for n in mc.tree.leaves() if mc.tree.traversed[n] > 0]
         assert len(traversed_leaves) == total_traversions[-1]
         assert total_traversions[-1] > 5, 'Must have traversed something!'
         # 55 after changing showdown equities to search index
@@ -137,3 +138,10 @@ class TestMonteCarlo:
             history.append((percentile, int(ev)))
             percentile += 1
         assert 0 <= percentile <= 100
+
+    def test_visit_mean_and_variance(self):
+        tree = ArrayTree()
+        for ev in [2, 4, 4, 4, 5, 5, 7, 9]:
+            tree.visit(tree.root, ev)
+        assert tree.mean[tree.root] == 5
+        assert abs(tree.variance(tree.root) - 32 / 7) < 1e-9
@@ -0,0 +1,65 @@
+from es.profiles import PlayerProfiles, history_prefix
+
+
+class TestPlayerProfiles:
+
+    def test_history_prefix(self):
+        actions = {'preflop_1': 'l', 'preflop_2': 'c', 'flop_1': 'k', 'turn_1': 'b'}
+        assert history_prefix(actions, 'preflop_1') == ''
+        assert history_prefix(actions, 'flop_1') == 'lc'
+        assert history_prefix(actions, 'turn_1') == 'lck.'
+
+    def test_add_and_get(self, tmpdir):
+        profiles = PlayerProfiles(str(tmpdir.join('profiles')))
+        for i in range(10):
+            profiles.add({'player': 'joe', 'site': 'CoinPoker', 'vs': 6, 'preflop_1': 'r' if i % 2 else 'f',
+                          'preflop_1_btp': 0.5 + i / 10, 'preflop_1_hs': i / 10,
+                          'flop_1': 'b', 'flop_1_hs': 0.9})
+        profiles.close()
+
+        # reopened from the shelve; 6 handed is in the same vs bucket as 4
+        profiles = PlayerProfiles(str(tmpdir.join('profiles')))
+        profile = profiles.get('joe', 'CoinPoker', 4, 'preflop_1', '', None)
+        assert profile['docs'] == 10
+        assert profile['actions'] == {'r': 5, 'f': 5}
+        assert abs(PlayerProfiles.quantile('btp', profile['btp'], 50) - 0.925) < 1e-9
+        assert PlayerProfiles.quantile('hs', profile['hs']['r'], 100) > PlayerProfiles.quantile('hs', profile['hs']['f'], 100)
+        assert profiles.get('joe', 'CoinPoker', 2, 'preflop_1', '', None) is None
+
+        profile = profiles.get('joe', 'CoinPoker', 6, 'flop_1', 'r.', None)
+        assert profile['actions'] == {'b': 5}
+        assert 0.9 <= PlayerProfiles.quantile('hs', profile['hs']['b'], 50) < 0.91
+
+    def test_pot_odds(self, tmpdir):
+        profiles = PlayerProfiles(str(tmpdir.join('profiles')))
+        profiles.add({'player': 'joe', 'site': 'CoinPoker', 'vs': 6, 'flop_1': 'k'})
+        profiles.add({'player': 'joe', 'site': 'CoinPoker', 'vs': 6, 'flop_1': 'f', 'flop_1_po': 0.33})
+        profiles.add({'player': 'joe', 'site': 'CoinPoker', 'vs': 6, 'flop_1': 'c', 'flop_1_po': 0.1})
+
+        # spots facing a bet are kept apart from the ones that are not, and by the size of the bet
+        assert profiles.get('joe', 'CoinPoker', 6, 'flop_1', '..', None)['actions'] == {'k': 1}
+        assert profiles.get('joe', 'CoinPoker', 6, 'flop_1', '..', 0.3)['actions'] == {'f': 1}
+        assert profiles.get('joe', 'CoinPoker', 6, 'flop_1', '..', 0.15)['actions'] == {'c': 1}
+        assert profiles.get('joe', 'CoinPoker', 6, 'flop_1', '..', 0.5) is None
+
+    def test_btp_overflow(self, tmpdir):
+        profiles = PlayerProfiles(str(tmpdir.join('profiles')))
+        for btp in [0.5, 4, 7.5]:
+            profiles.add({'player': 'joe', 'site': 'CoinPoker', 'vs': 2, 'river_1': 'b', 'river_1_btp': btp})
+        profile = profiles.get('joe', 'CoinPoker', 2, 'river_1', '......', None)
+        assert profile['btp_max'] == 7.5
+        assert PlayerProfiles.quantile('btp', profile['btp'], 10, profile['btp_max']) < 1
+        assert PlayerProfiles.quantile('btp', profile['btp'], 90, profile['btp_max']) == 7.5
+        assert PlayerProfiles.quantile('btp', profile['btp'], 90) == 3
+
+    def test_saved_again(self, tmpdir):
+        profiles = PlayerProfiles(str(tmpdir.join('profiles')))
+        doc = {'_id': 'joe1000jane1000rc', 'player': 'joe', 'site': 'CoinPoker', 'vs': 2, 'preflop_1': 'r'}
+        profiles.add(doc)
+        profiles.add({'player': 'joe', 'site': 'CoinPoker', 'vs': 2, 'preflop_1': 'c'})
+        profiles.close()
+
+        # the stored doc is replaced, the profile counts it once
+        profiles = PlayerProfiles(str(tmpdir.join('profiles')))
+        profiles.add(doc)
+        assert profiles.get('joe', 'CoinPoker', 2, 'preflop_1', '', None)['actions'] == {'r': 1, 'c': 1}
@@ -1,4 +1,12 @@
-from pe.pe import req_equities
+import asyncio
+
+import numpy as np
+
+from pe import evaluator
+from pe.board import BoardMatrix, pocket_indexes
+from pe.preflop import PreflopTable
+from pe.pe import PE, req_equities, req_equities_async, req_equities_batch_async, encode_range, range_product, \
+    canonical, is_exact
 
 
 class TestPokerEval:
@@ -17,3 +25,101 @@ class TestPokerEval:
         assert res['info'][0] == 20000
         assert res['eval'][0]['ev'] == 850
         assert res['eval'][1]['ev'] == 149
+
+    def test_native_equities(self):
+        board = ['__'] * 5
+        pockets = [['as', 'ac'], ['__'] * 2]
+        res = evaluator.equities(board, pockets, 20000)
+        assert res['info'][0] == 20000
+        assert 835 <= res['eval'][0]['ev'] <= 865
+        assert 135 <= res['eval'][1]['ev'] <= 165
+
+    def test_native_exact_river(self):
+        board = ['2h', '3h', '4d', '5c', 'kd']
+        pockets = [['as', 'ac'], ['kh', 'ks']]
+        res = evaluator.equities(board, pockets, exact=True)
+        # wheel beats trips
+        assert res['info'][0] == 1
+        assert res['eval'][0]['ev'] == 1000
+        assert res['eval'][1]['ev'] == 0
+
+    def test_req_equities_async(self, monkeypatch):
+        monkeypatch.setattr(PE, 'EVALUATOR', 'native')
+        board = ['2h', '3h', '4d', '5c', 'kd']
+        jobs = [(board, [['as', 'ac'], ['kh', 'ks']]), (board, [['kh', 'ks'], ['qh', 'qs']])]
+
+        async def requests():
+            # awaited together, each on a thread of the pool
+            return await asyncio.gather(req_equities_async(*jobs[0]), req_equities_batch_async(jobs))
+
+        loop = asyncio.new_event_loop()
+        try:
+            res, batch = loop.run_until_complete(requests())
+        finally:
+            loop.close()
+        assert res == req_equities(*jobs[0])
+        assert [r['eval'][0]['ev'] for r in batch] == [1000, 1000]
+
+    def test_range_product_skips_duplicate_cards(self):
+        board = ['as', '2h', '7d', '__', '__']
+        ranges = [
+            encode_range([('ac', 'ad'), ('as', 'ks')]),
+            encode_range([('ac', 'kd'), ('qh', 'qs'), ('2h', '2c')]),
+        ]
+        combos = range_product(ranges, board)
+        pairs = list(zip(*combos))
+        # 'as' is on the board, 'ac' is shared and '2h' is on the board
+        assert pairs == [(0, 1)]
+
+    def test_canonical_suit_isomorphism(self):
+        key = canonical(['2h', '3h', '4d', '__', '__'], [['as', 'ks'], ['__', '__']])
+        assert key == canonical(['4c', '2s', '3s', '__', '__'], [['kh', 'ah'], ['__', '__']])
+        assert key != canonical(['2h', '3h', '4d', '__', '__'], [['ad', 'kd'], ['__', '__']])
+        # seats are not interchangeable
+        assert canonical(['__'] * 5, [['as', 'ac'], ['kd', 'kh']]) != canonical(['__'] * 5, [['kd', 'kh'], ['as', 'ac']])
+
+    def test_exact_on_late_streets(self):
+        assert is_exact(['2h', '3h', '4d', '5c', 'kd'], [['as', 'ac'], ['__', '__']])
+        assert is_exact(['2h', '3h', '4d', '5c', '__'], [['as', 'ac'], ['kh', 'ks']])
+        assert not is_exact(['2h', '3h', '4d', '5c', '__'], [['as', 'ac'], ['__', '__']])
+        assert not is_exact(['__'] * 5, [['as', 'ac'], ['kh', 'ks']])
+
+    def test_board_matrix(self):
+        matrix = BoardMatrix(['ah', 'kd', '2c'])
+        first = pocket_indexes([('as', 'ac'), ('qs', 'qh')])
+        second = pocket_indexes([('kh', 'ks'), ('qd', 'jd')])
+        for (a, b), equity in zip([(['as', 'ac'], ['kh', 'ks']), (['qs', 'qh'], ['qd', 'jd'])],
+                                  matrix.equities(first, second)):
+            exact = evaluator.equities(['ah', 'kd', '2c', '__', '__'], [a, b], exact=True)
+            assert abs(equity - exact['eval'][0]['ev'] / 1000) < 0.002
+        matrix = matrix.narrowed(['ah', 'kd', '2c', '7s', '9s'])
+        assert len(matrix.runouts) == 1
+        assert list(matrix.equities(first, second)) == [1, 1]
+
+    def test_preflop_hand_classes(self):
+        classes = {PreflopTable.hand_class(p) for c in range(PreflopTable.CLASSES)
+                   for p in PreflopTable.class_pockets(c)}
+        assert len(classes) == 169
+        assert sum(len(PreflopTable.class_pockets(c)) for c in range(PreflopTable.CLASSES)) == 1326
+        assert PreflopTable.hand_class(['as', 'ks']) == PreflopTable.hand_class(['kh', 'ah'])
+        assert PreflopTable.hand_class(['as', 'ks']) != PreflopTable.hand_class(['as', 'kh'])
+
+    def test_preflop_pairs(self, tmpdir):
+        key = PreflopTable.pair_key
+        # suits are relabelled, but how they fall across the pockets is kept
+        assert key(['as', 'ks'], ['qs', 'js']) == key(['kh', 'ah'], ['jh', 'qh'])
+        assert key(['as', 'ks'], ['qs', 'js']) != key(['as', 'ks'], ['qh', 'jh'])
+        assert key(['as', 'ks'], ['qh', 'jh']) == key(['ad', 'kd'], ['qc', 'jc'])
+        assert key(['as', 'ks'], ['qs', 'js']) != key(['qs', 'js'], ['as', 'ks'])
+
+        classes = PreflopTable.CLASSES
+        table = PreflopTable(np.zeros((classes, PreflopTable.MAX_OPPONENTS)), np.full((classes, classes), 0.5),
+                             [key(['as', 'ks'], ['qh', 'jh']), key(['as', 'ks'], ['qs', 'js'])], [0.6, 0.65])
+        path = str(tmpdir.join('preflop.bin'))
+        table.save(path)
+        table = PreflopTable.load(path)
+        assert abs(table.equity_vs_pocket(['ah', 'kh'], ['qh', 'jh']) - 0.65) < 1e-6
+        assert abs(table.equity_vs_pocket(['ah', 'kh'], ['qs', 'js']) - 0.6) < 1e-6
+        # the other order of a pair
+        assert abs(table.equity_vs_pocket(['qs', 'js'], ['ah', 'kh']) - 0.4) < 1e-6
+        assert table.equity_vs_pocket(['2s', '2h'], ['ah', 'kh']) is None
@@ -0,0 +1,48 @@
+import time
+
+from es.cache import QueryCache
+
+
+class TestQueryCache:
+
+    def test_key_is_normalised(self):
+        assert QueryCache.key({'a': 1, 'b': [1, 2]}) == QueryCache.key({'b': [1, 2], 'a': 1})
+        assert QueryCache.key({'a': 1}) != QueryCache.key({'a': 2})
+
+    def test_fetch_evict_and_invalidate(self):
+        cache = QueryCache(2, 60)
+        calls = []
+
+        def compute(value):
+            return lambda: calls.append(value) or value
+
+        assert cache.fetch({'q': 1}, 'joe', compute(1)) == 1
+        assert cache.fetch({'q': 1}, 'joe', compute(1)) == 1
+        assert calls == [1]
+        cache.fetch({'q': 2}, 'jane', compute(2))
+        # least recently used is evicted
+        cache.fetch({'q': 1}, 'joe', compute(1))
+        cache.fetch({'q': 3}, 'joe', compute(3))
+        assert cache.get(cache.key({'q': 2})) is None
+
+        cache.invalidate('joe')
+        assert cache.fetch({'q': 1}, 'joe', compute(1)) == 1
+        assert calls == [1, 2, 3, 1]
+        info = cache.info()
+        # the get of the evicted query is a miss too
+        assert (info['hits'], info['misses'], info['evicted'], info['invalidated']) == (2, 5, 1, 2)
+
+    def test_ttl_and_fetch_many(self):
+        cache = QueryCache(10, 0.01)
+        cache.fetch({'q': 1}, 'joe', lambda: 1)
+        batches = []
+
+        def compute_many(queries):
+            batches.append(queries)
+            return [q['q'] * 10 for q in queries]
+
+        assert cache.fetch_many([{'q': 1}, {'q': 2}], ['joe', 'jane'], compute_many) == [1, 20]
+        assert batches == [[{'q': 2}]]
+        time.sleep(0.02)
+        assert cache.fetch_many([{'q': 1}, {'q': 2}], ['joe', 'jane'], compute_many) == [10, 20]
+        assert cache.info()['expired'] == 2
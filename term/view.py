@@ -73,8 +73,8 @@ class View:
             #     roc = sum(self.mc.rolling_10) / sum(self.mc.rolling_40)
             #     print(Style.NORMAL + Fore.WHITE + 'ROC: {:.0f}'.format(roc * 100))
 
-            actions = [(c.data['action'], c.data['ev'], c.data['traversed'])
-                       for c in self.mc.tree.children(self.mc.tree.root)]
+            # the background search is not held up by printing
+            actions = self.mc_service.actions() if self.mc_service else self.mc.current_actions
             actions.sort(key=itemgetter(1), reverse=True)
             evs = np.array([i[1] for i in actions])
             for action in actions:
@@ -89,7 +89,11 @@ class View:
         self.print_ev_history()
 
     def print_ev_history(self):
-        ev_history = self.mc.ev_history[self.engine.s]
+        # a copy, the background search keeps adding to it
+        if self.mc_service:
+            ev_history = self.mc_service.ev_history(self.engine.s)
+        else:
+            ev_history = self.mc.ev_history[self.engine.s]
         if not ev_history:
             return
         plot(range(len(ev_history)), ev_history, columns=50, rows=10)